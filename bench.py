@@ -0,0 +1,497 @@
+#!/usr/bin/env python3
+"""
+Git Bot Benchmarks
+==================
+量測 Bot 內部元件的效能（不需要 Telegram 連線）
+
+使用方式:
+    uv run bench.py concurrent [-n 10] [--delay 0.5]
+    uv run bench.py spawn [-n 200]
+    uv run bench.py scan [-n 20]
+    uv run bench.py latency [-n 20] [--rtt 50] [--burst 1]  # 需要 [webhooks] extra
+    uv run bench.py rpc [-n 50] [--agents 2]
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from urllib.parse import parse_qsl
+
+import httpx
+
+# ============================================================
+# 測試環境
+# ============================================================
+
+
+def make_repo(path: Path, files: int = 200) -> Path:
+    """建立一個有 commit 的測試 repo"""
+    path.mkdir(parents=True, exist_ok=True)
+    subprocess.run(["git", "init", "-q"], cwd=path, check=True)
+    for i in range(files):
+        (path / f"file_{i}.txt").write_text(f"line {i}\n" * 50)
+    subprocess.run(["git", "add", "."], cwd=path, check=True)
+    subprocess.run(
+        ["git", "-c", "user.name=bench", "-c", "user.email=bench@localhost",
+         "commit", "-q", "-m", "init"],
+        cwd=path,
+        check=True,
+    )
+    return path
+
+
+def load_bot(workdir: Path, **overrides):
+    """以臨時 config 載入 main 模組"""
+    cfg = {
+        "machine_name": "bench",
+        "allowed_paths": [str(workdir)],
+        "allowed_user_ids": [],
+        "allowed_git_commands": ["status", "log", "diff", "branch", "fetch"],
+        "command_timeout": 60,
+        "max_output_length": 3500,
+        **overrides,
+    }
+    cfg_file = workdir / "config.json"
+    cfg_file.write_text(json.dumps(cfg))
+    os.environ["GIT_BOT_CONFIG"] = str(cfg_file)
+    sys.path.insert(0, str(Path(__file__).parent))
+    import main
+
+    return main
+
+
+# ============================================================
+# Benchmarks
+# ============================================================
+
+
+async def measure_loop_lag(stop: asyncio.Event) -> float:
+    """回傳 event loop 最長的卡住時間（秒）"""
+    worst = 0.0
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(0.001)
+        worst = max(worst, time.perf_counter() - start - 0.001)
+    return worst
+
+
+async def time_concurrent(bot, repos: list[Path], git_cmd: str) -> None:
+    """比較 1 個、N 個阻塞式、N 個 async 同時執行的耗時與 loop 卡住時間"""
+    n = len(repos)
+    repo = repos[0]
+    await bot.execute_git_command(repo, git_cmd)  # 暖身
+
+    start = time.perf_counter()
+    await bot.execute_git_command(repo, git_cmd)
+    single = time.perf_counter() - start
+
+    # 舊版：在 event loop 裡直接呼叫 subprocess.run
+    stop = asyncio.Event()
+    lag = asyncio.create_task(measure_loop_lag(stop))
+    await asyncio.sleep(0)
+    start = time.perf_counter()
+    for r in repos:
+        subprocess.run(f"git {git_cmd}", shell=True, cwd=r, capture_output=True)
+    blocking = time.perf_counter() - start
+    stop.set()
+    blocking_lag = await lag
+
+    stop = asyncio.Event()
+    lag = asyncio.create_task(measure_loop_lag(stop))
+    await asyncio.sleep(0)
+    start = time.perf_counter()
+    await asyncio.gather(*(bot.execute_git_command(r, git_cmd) for r in repos))
+    concurrent = time.perf_counter() - start
+    stop.set()
+    concurrent_lag = await lag
+
+    print(f"git {git_cmd}")
+    print(f"  1 x async               : {single * 1000:8.1f} ms")
+    print(
+        f"  {n} x blocking (baseline): {blocking * 1000:8.1f} ms"
+        f"  (loop stall {blocking_lag * 1000:.1f} ms)"
+    )
+    print(
+        f"  {n} x async concurrent   : {concurrent * 1000:8.1f} ms"
+        f"  (loop stall {concurrent_lag * 1000:.1f} ms)"
+    )
+
+
+async def bench_concurrent(n: int, delay: float) -> None:
+    """N 個同時的 git status 與單一 status 的耗時比較"""
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = Path(tmp)
+        repo = make_repo(workdir / "repo")
+        bot = load_bot(workdir)
+
+        print(f"CPU cores: {os.cpu_count()}")
+        await time_concurrent(bot, [repo] * n, "status")
+        # 用 alias 模擬等待網路的 fetch / pull（會寫入的指令，每個 repo 一個）
+        repos = [make_repo(workdir / f"repo{i}", files=1) for i in range(n)]
+        await time_concurrent(
+            bot, repos, f"-c 'alias.slow=!sleep {delay}; git status' slow"
+        )
+
+
+async def bench_spawn(n: int) -> None:
+    """比較經過 /bin/sh 與直接 exec git 的啟動延遲"""
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = Path(tmp)
+        repo = make_repo(workdir / "repo", files=1)
+        bot = load_bot(workdir)
+
+        async def via_shell() -> None:
+            proc = await asyncio.create_subprocess_shell(
+                "git --version",
+                cwd=repo,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                env={**os.environ, "GIT_TERMINAL_PROMPT": "0"},
+                start_new_session=True,
+            )
+            await proc.communicate()
+
+        async def via_exec() -> None:
+            proc = await asyncio.create_subprocess_exec(
+                bot.GIT_BIN,
+                "--version",
+                cwd=repo,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                env=bot.GIT_ENV,
+                start_new_session=True,
+            )
+            await proc.communicate()
+
+        for name, spawn in [("shell=True", via_shell), ("argv exec", via_exec)]:
+            await spawn()  # 暖身
+            start = time.perf_counter()
+            for _ in range(n):
+                await spawn()
+            per_call = (time.perf_counter() - start) / n
+            print(f"{name:10}: {per_call * 1000:6.2f} ms / spawn  (n={n})")
+
+
+def make_home_tree(base: Path, n: int) -> None:
+    """建立類似家目錄的測試樹：repo、node_modules、沒用 . 開頭的 venv、Library"""
+    for i in range(n):
+        (base / "code" / f"repo{i}" / ".git").mkdir(parents=True)
+        site = base / f"site{i}"
+        for j in range(100):
+            (site / "node_modules" / f"pkg{j}" / "lib").mkdir(parents=True)
+        (site / ".git").mkdir()
+        for j in range(20):
+            (base / f"tool{i}" / "venv" / f"lib{j}").mkdir(parents=True)
+        (base / f"tool{i}" / "venv" / "pyvenv.cfg").write_text("home = /usr\n")
+        for j in range(50):
+            (base / "Library" / f"app{i}" / f"cache{j}").mkdir(parents=True)
+        for j in range(20):
+            (base / "web" / f"dist{i}" / "node_modules" / f"m{j}").mkdir(parents=True)
+
+
+def bench_scan(n: int, rounds: int = 5) -> None:
+    """比較沒有任何排除規則與預設排除規則的 repo 掃描耗時"""
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = Path(tmp)
+        bot = load_bot(workdir)
+        make_home_tree(workdir, n)
+        default = bot.prune
+
+        for name, rules in [
+            ("no pruning", bot.PruneRules([workdir], [], False)),
+            ("default excludes", default),
+        ]:
+            bot.prune = rules
+            walk = bot.walk_tree(workdir, lambda p, d: bot.scan_dir(p, d < 3))
+            dirs = sum(1 for _ in walk)
+            start = time.perf_counter()
+            for _ in range(rounds):
+                repos = bot.find_git_repos(workdir)
+            elapsed = (time.perf_counter() - start) / rounds
+            print(
+                f"{name:16}: {elapsed * 1000:7.1f} ms  "
+                f"({dirs} dirs, {len(repos)} repos)"
+            )
+        bot.prune = default
+
+
+class FakeBotAPI:
+    """本機的假 Bot API：getUpdates 長輪詢，setWebhook 之後改用 POST 推送 update
+
+    每個 request 與 response 都延遲 rtt / 2，模擬到 Telegram 的網路往返。
+    """
+
+    def __init__(self, rtt: float) -> None:
+        self.delay = rtt / 2
+        self.pending: asyncio.Queue[dict] = asyncio.Queue()
+        self.replies: asyncio.Queue[tuple[int, float]] = asyncio.Queue()
+        self.webhook: tuple[str, str] | None = None
+        self.client: httpx.AsyncClient | None = None
+        self.next_id = 1
+
+    async def start(self) -> str:
+        server = await asyncio.start_server(self.serve, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        return f"http://127.0.0.1:{port}/bot"
+
+    async def serve(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        """極簡 HTTP/1.1 keep-alive"""
+        try:
+            while line := await reader.readline():
+                _, target, _ = line.decode().split(" ", 2)
+                headers = {}
+                while (h := await reader.readline()) not in (b"\r\n", b""):
+                    key, value = h.decode().split(":", 1)
+                    headers[key.lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                params = {}
+                for key, value in parse_qsl(body.decode()):
+                    try:
+                        params[key] = json.loads(value)
+                    except ValueError:
+                        params[key] = value
+
+                await asyncio.sleep(self.delay)
+                result = await self.call(target.rsplit("/", 1)[-1], params)
+                await asyncio.sleep(self.delay)
+                payload = json.dumps({"ok": True, "result": result}).encode()
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                    b"Content-Length: %d\r\n\r\n" % len(payload) + payload
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def call(self, method: str, params: dict):
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "bench", "username": "b"}
+        if method == "setWebhook":
+            self.webhook = (params["url"], params.get("secret_token", ""))
+            return True
+        if method == "deleteWebhook":
+            self.webhook = None
+            return True
+        if method == "getUpdates":
+            try:
+                update = await asyncio.wait_for(
+                    self.pending.get(), timeout=params.get("timeout", 0)
+                )
+            except TimeoutError:
+                return []
+            updates = [update]
+            while not self.pending.empty():
+                updates.append(self.pending.get_nowait())
+            return updates
+        if method in ("sendMessage", "editMessageText"):
+            self.replies.put_nowait((params["chat_id"], time.perf_counter()))
+            return {
+                "message_id": self.next_id,
+                "date": int(time.time()),
+                "chat": {"id": params["chat_id"], "type": "private"},
+                "text": params["text"],
+            }
+        return True
+
+    def make_update(self, text: str) -> dict:
+        """每個 update 用不同的 chat，回覆時才對得起來"""
+        self.next_id += 1
+        return {
+            "update_id": self.next_id,
+            "message": {
+                "message_id": self.next_id,
+                "date": int(time.time()),
+                "chat": {"id": self.next_id, "type": "private"},
+                "from": {"id": self.next_id, "is_bot": False, "first_name": "bench"},
+                "text": text,
+                "entities": [{"type": "bot_command", "offset": 0, "length": len(text)}],
+            },
+        }
+
+    async def deliver(self, update: dict) -> None:
+        """polling 放進 getUpdates 佇列；webhook 則延遲 rtt / 2 後 POST 給 bot"""
+        if self.webhook is None:
+            self.pending.put_nowait(update)
+            return
+        url, secret = self.webhook
+        self.client = self.client or httpx.AsyncClient()
+        await asyncio.sleep(self.delay)
+        await self.client.post(
+            url, json=update, headers={"X-Telegram-Bot-Api-Secret-Token": secret}
+        )
+
+
+async def bench_latency(n: int, rtt: float, burst: int) -> None:
+    """從 update 產生到 bot 回覆（sendMessage 到達）的端對端延遲
+
+    每一輪連續送出 burst 個 update（間隔 5 ms）；polling 時晚到的 update
+    要等下一次 getUpdates。
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        bot = load_bot(Path(tmp))
+        logging.getLogger("httpx").setLevel(logging.WARNING)
+        logging.getLogger("telegram").setLevel(logging.WARNING)
+        api = FakeBotAPI(rtt / 1000)
+        base_url = await api.start()
+
+        for mode in ("polling", "webhook"):
+            app = bot.build_application("123:bench", base_url=base_url)
+            async with app:
+                await app.start()
+                if mode == "polling":
+                    await app.updater.start_polling(poll_interval=0, timeout=10)
+                else:
+                    await app.updater.start_webhook(
+                        listen="127.0.0.1",
+                        port=18443,
+                        url_path="hook",
+                        webhook_url="http://127.0.0.1:18443/hook",
+                        secret_token="bench",
+                    )
+                await asyncio.sleep(0.2)
+
+                samples = []
+                for _ in range(n):
+                    sent = {}
+                    for _ in range(burst):
+                        update = api.make_update("/status")
+                        sent[update["message"]["chat"]["id"]] = time.perf_counter()
+                        asyncio.create_task(api.deliver(update))
+                        await asyncio.sleep(0.005)
+                    for _ in range(burst):
+                        chat_id, arrived = await api.replies.get()
+                        samples.append(arrived - sent[chat_id])
+                    await asyncio.sleep(0.05)
+
+                await app.updater.stop()
+                await app.stop()
+
+            samples.sort()
+            print(
+                f"{mode:8}: median {samples[len(samples) // 2] * 1000:6.1f} ms  "
+                f"p90 {samples[int(len(samples) * 0.9)] * 1000:6.1f} ms  "
+                f"(n={len(samples)}, burst {burst}, rtt {rtt:.0f} ms)"
+            )
+
+
+async def bench_rpc(n: int, agents: int) -> None:
+    """本機 gateway + 多個 agent 子程序：比較本機執行與經由 RPC 轉送的延遲"""
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = Path(tmp)
+        repo = make_repo(workdir / "repo", files=20)
+        common = {
+            "rpc_address": f"unix:{workdir / 'rpc.sock'}",
+            "rpc_secret": "bench-secret",
+        }
+        bot = load_bot(workdir, mode="gateway", **common)
+        logging.getLogger("main").setLevel(logging.WARNING)
+        await bot.gateway.start()
+
+        procs = []
+        for i in range(agents):
+            agent_dir = workdir / f"agent{i}"
+            agent_dir.mkdir()
+            cfg = {
+                "machine_name": f"agent{i}",
+                "allowed_paths": [str(workdir)],
+                "allowed_user_ids": [],
+                "allowed_git_commands": ["status", "log"],
+                "mode": "agent",
+                **common,
+            }
+            cfg_file = agent_dir / "config.json"
+            cfg_file.write_text(json.dumps(cfg))
+            procs.append(
+                subprocess.Popen(
+                    [sys.executable, str(Path(__file__).parent / "main.py")],
+                    env={**os.environ, "GIT_BOT_CONFIG": str(cfg_file)},
+                    stderr=subprocess.DEVNULL,
+                )
+            )
+        try:
+            while len(bot.gateway.agents) < agents:
+                await asyncio.sleep(0.05)
+
+            async def local() -> None:
+                await bot.run_git_request(0, str(repo), "log -1 --oneline")
+
+            async def forwarded() -> None:
+                await bot.gateway.forward("agent0", 0, str(repo), "log -1 --oneline")
+
+            async def fan_out() -> None:
+                await asyncio.gather(
+                    *(
+                        bot.gateway.forward(f"agent{i}", 0, "repo", "log -1 --oneline")
+                        for i in range(agents)
+                    )
+                )
+
+            for name, call in [
+                ("local", local),
+                ("via agent", forwarded),
+                (f"{agents} agents", fan_out),
+            ]:
+                await call()  # 暖身
+                samples = []
+                for _ in range(n):
+                    start = time.perf_counter()
+                    await call()
+                    samples.append(time.perf_counter() - start)
+                samples.sort()
+                print(f"{name:10}: median {samples[n // 2] * 1000:6.2f} ms  (n={n})")
+        finally:
+            for proc in procs:
+                proc.terminate()
+                proc.wait()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    p = sub.add_parser("concurrent", help="N 個同時的 git status")
+    p.add_argument("-n", type=int, default=10)
+    p.add_argument("--delay", type=float, default=0.5, help="模擬網路等待秒數")
+
+    p = sub.add_parser("spawn", help="shell vs. 直接 exec 的啟動延遲")
+    p.add_argument("-n", type=int, default=200)
+
+    p = sub.add_parser("scan", help="repo 掃描的排除規則")
+    p.add_argument("-n", type=int, default=20, help="每種資料夾的數量")
+
+    p = sub.add_parser("latency", help="polling vs. webhook 的端對端延遲")
+    p.add_argument("-n", type=int, default=20)
+    p.add_argument("--rtt", type=float, default=50, help="模擬到 Telegram 的往返 ms")
+    p.add_argument("--burst", type=int, default=1, help="每輪連續送出的 update 數")
+
+    p = sub.add_parser("rpc", help="gateway 轉送給 agent 的額外延遲")
+    p.add_argument("-n", type=int, default=50)
+    p.add_argument("--agents", type=int, default=2)
+
+    args = parser.parse_args()
+
+    if args.bench == "concurrent":
+        asyncio.run(bench_concurrent(args.n, args.delay))
+    elif args.bench == "spawn":
+        asyncio.run(bench_spawn(args.n))
+    elif args.bench == "scan":
+        bench_scan(args.n)
+    elif args.bench == "latency":
+        asyncio.run(bench_latency(args.n, args.rtt, args.burst))
+    elif args.bench == "rpc":
+        asyncio.run(bench_rpc(args.n, args.agents))
+
+
+if __name__ == "__main__":
+    main()
@@ -10,18 +10,43 @@ Telegram Git Bot Agent
     /git office ~/work/api status
 """
 
+import asyncio
+import ctypes
+import difflib
+import errno
+import fnmatch
+import gzip
+import hashlib
+import hmac
+import itertools
 import json
 import logging
 import os
 import re
-import subprocess
+import secrets
+import shlex
+import shutil
+import signal
+import stat
+import struct
+import tempfile
+import threading
+import time
+from collections import OrderedDict, deque
+from collections.abc import Awaitable, Callable, Iterator
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import asynccontextmanager, suppress
+from contextvars import ContextVar, copy_context
 from dataclasses import dataclass
 from pathlib import Path
+from urllib.parse import urlsplit
 
 from dotenv import load_dotenv
-from telegram import Update
-from telegram.ext import (Application, CommandHandler, ContextTypes,
-                          MessageHandler, filters)
+from telegram import (InlineKeyboardButton, InlineKeyboardMarkup, InputFile,
+                      Message, Update)
+from telegram.error import RetryAfter, TelegramError
+from telegram.ext import (Application, BaseUpdateProcessor, CallbackQueryHandler,
+                          CommandHandler, ContextTypes, MessageHandler, filters)
 
 # ============================================================
 # 設定
@@ -35,7 +60,29 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-CONFIG_FILE = Path(__file__).parent / "config.json"
+CONFIG_FILE = Path(
+    os.getenv("GIT_BOT_CONFIG", Path(__file__).parent / "config.json")
+)
+
+
+# 掃描 repo 時預設跳過的資料夾（gitignore 風格，開頭 / 表示只比對允許路徑的第一層）
+DEFAULT_EXCLUDES = [
+    "node_modules",
+    "bower_components",
+    "__pycache__",
+    "site-packages",
+    "venv",
+    "virtualenv",
+    "Pods",
+    "DerivedData",
+    "build",
+    "dist",
+    "target",
+    "/Library",
+    "/Movies",
+    "/Music",
+    "/Pictures",
+]
 
 
 @dataclass
@@ -48,155 +95,2823 @@ class Config:
     allowed_git_commands: list[str]
     command_timeout: int
     max_output_length: int
+    fast_workers: int
+    slow_workers: int
+    stream_edit_interval: float
+    output_mode: str
+    stop_at_output_cap: bool
+    output_byte_budget: int
+    send_overflow_document: bool
+    document_gzip_bytes: int
+    max_document_bytes: int
+    result_cache_size: int
+    result_cache_ttl: float
+    result_cache_worktree_ttl: float
+    watch_repos: bool
+    rescan_interval: float
+    scan_workers: int
+    exclude_patterns: list[str]
+    one_file_system: bool
+    list_cache_ttl: float
+    validation_timeout: float
+    webhook_url: str
+    webhook_listen: str
+    webhook_port: int
+    webhook_path: str
+    webhook_secret: str
+    max_concurrent_updates: int
+    mode: str
+    rpc_address: str
+    rpc_secret: str
+    machine_groups: dict[str, list[str]]
+    fanout_deadline: float
+    heartbeat_interval: float
+
+    @classmethod
+    def load(cls, path: Path) -> "Config":
+        """從 JSON 檔載入設定"""
+        with open(path) as f:
+            data = json.load(f)
+
+        return cls(
+            machine_name=data["machine_name"],
+            allowed_paths=[
+                Path(p).expanduser().resolve() for p in data["allowed_paths"]
+            ],
+            allowed_user_ids=data["allowed_user_ids"],
+            allowed_git_commands=data["allowed_git_commands"],
+            command_timeout=data.get("command_timeout", 60),
+            max_output_length=data.get("max_output_length", 3500),
+            fast_workers=data.get("fast_workers", 4),
+            slow_workers=data.get("slow_workers", 2),
+            stream_edit_interval=data.get("stream_edit_interval", 2.0),
+            output_mode=data.get("output_mode", "head"),
+            stop_at_output_cap=data.get("stop_at_output_cap", False),
+            output_byte_budget=data.get("output_byte_budget", 0),
+            send_overflow_document=data.get("send_overflow_document", False),
+            document_gzip_bytes=data.get("document_gzip_bytes", 1_000_000),
+            max_document_bytes=data.get("max_document_bytes", 50_000_000),
+            result_cache_size=data.get("result_cache_size", 256),
+            result_cache_ttl=data.get("result_cache_ttl", 30),
+            result_cache_worktree_ttl=data.get("result_cache_worktree_ttl", 5),
+            watch_repos=data.get("watch_repos", False),
+            rescan_interval=data.get("rescan_interval", 300),
+            scan_workers=data.get("scan_workers", 8),
+            exclude_patterns=data.get("exclude_patterns", DEFAULT_EXCLUDES),
+            one_file_system=data.get("one_file_system", True),
+            list_cache_ttl=data.get("list_cache_ttl", 600),
+            validation_timeout=data.get("validation_timeout", 5),
+            webhook_url=data.get("webhook_url", ""),
+            webhook_listen=data.get("webhook_listen", "127.0.0.1"),
+            webhook_port=data.get("webhook_port", 8443),
+            webhook_path=data.get("webhook_path", ""),
+            webhook_secret=data.get("webhook_secret", ""),
+            max_concurrent_updates=data.get("max_concurrent_updates", 16),
+            mode=data.get("mode", "standalone"),
+            rpc_address=data.get("rpc_address", "127.0.0.1:7700"),
+            rpc_secret=data.get("rpc_secret", ""),
+            machine_groups=data.get("machine_groups", {}),
+            fanout_deadline=data.get("fanout_deadline", 30),
+            heartbeat_interval=data.get("heartbeat_interval", 15),
+        )
+
+
+config = Config.load(CONFIG_FILE)
+
+REPO_INDEX_FILE = CONFIG_FILE.parent / "repo_index.json"
+
+# /list 每頁顯示的 repo 數
+LIST_PAGE_SIZE = 30
+
+
+# ============================================================
+# 安全檢查
+# ============================================================
+
+
+def is_user_allowed(user_id: int) -> bool:
+    """檢查使用者是否有權限"""
+    if not config.allowed_user_ids:
+        return True
+    return user_id in config.allowed_user_ids
+
+
+class PathAllowlist:
+    """允許路徑編成以路徑元件為節點的 trie，檢查時只走一次目標路徑"""
+
+    def __init__(self, allowed: list[Path], home: Path) -> None:
+        self.home = str(home)
+        self.root: dict[str, dict] = {}
+        for path in allowed:
+            node = self.root
+            for part in str(path).split(os.sep):
+                if part:
+                    node = node.setdefault(part, {})
+            node[""] = {}  # 結尾標記（路徑元件不會是空字串）
+
+    def allows(self, resolved: str) -> bool:
+        """resolved 必須是已解析的絕對路徑"""
+        # 不允許直接操作 home 目錄本身
+        if resolved == self.home:
+            return False
+        node = self.root
+        for part in resolved.split(os.sep):
+            if "" in node:
+                return True
+            if part:
+                node = node.get(part)
+                if node is None:
+                    return False
+        return "" in node
+
+
+allowlist = PathAllowlist(config.allowed_paths, Path.home().resolve())
+
+
+def resolve_path(path_str: str) -> str:
+    """展開 ~ 並解析 symlink
+
+    每次都重新解析、不快取：路徑中任何一層之後都可能被換成 symlink
+    （例如 pull / checkout 建立的），快取的結果會讓指令跑到 allowlist 外面。
+    """
+    return os.path.realpath(os.path.expanduser(path_str))
+
+
+def check_target(path_str: str) -> tuple[Path, str | None]:
+    """解析並檢查 /git 的目標；回傳 (實際路徑, 錯誤)，通過時錯誤為 None
+
+    錯誤是 "invalid"、"missing"、"not_dir"、"not_allowed" 或 "not_repo"。
+    正常情況只 stat 一次 .git，失敗時才再 stat 目標本身分辨原因。
+    """
+    try:
+        resolved = resolve_path(path_str)
+    except (OSError, ValueError):
+        return Path(path_str), "invalid"
+    target = Path(resolved)
+    try:
+        if stat.S_ISDIR(os.stat(os.path.join(resolved, ".git")).st_mode):
+            return target, None if allowlist.allows(resolved) else "not_allowed"
+    except (OSError, ValueError):
+        pass
+    try:
+        st = os.stat(resolved)
+    except (OSError, ValueError):
+        return target, "missing"
+    if not stat.S_ISDIR(st.st_mode):
+        return target, "not_dir"
+    if not allowlist.allows(resolved):
+        return target, "not_allowed"
+    return target, "not_repo"
+
+
+# 專用的 thread pool：卡住的 NFS / 休眠的外接硬碟不會佔滿 asyncio 預設的 executor
+validation_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="path-check")
+
+
+async def validate_target(path_str: str) -> tuple[Path, str | None]:
+    """在 thread pool 執行 check_target；超過 validation_timeout 時錯誤為 timeout"""
+    loop = asyncio.get_running_loop()
+    try:
+        return await asyncio.wait_for(
+            loop.run_in_executor(validation_pool, check_target, path_str),
+            timeout=config.validation_timeout,
+        )
+    except asyncio.TimeoutError:
+        logger.warning(f"檢查路徑逾時: {path_str}")
+        return Path(path_str), "timeout"
+
+
+def is_valid_git_command(cmd: str) -> tuple[bool, str]:
+    """檢查是否為允許的 git 指令"""
+    cmd = cmd.strip()
+    if not cmd:
+        return False, ""
+    first_word = cmd.split()[0]
+    return first_word in config.allowed_git_commands, first_word
+
+
+def sanitize_input(text: str) -> str:
+    """移除危險字元"""
+    return re.sub(r"[;&|`$(){}\\]", "", text)
+
+
+# 有這些檔案的資料夾不往下掃（例如沒有用 . 開頭命名的 virtualenv）
+PRUNE_MARKERS = {"pyvenv.cfg"}
+
+
+def read_mount_points() -> set[str] | None:
+    """從 /proc/self/mountinfo 讀出所有掛載點；不是 Linux 時回傳 None"""
+    try:
+        with open("/proc/self/mountinfo") as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return None
+    # 第 5 欄是掛載點，空白等字元以 \040 這種八進位跳脫
+    return {
+        re.sub(r"\\([0-7]{3})", lambda m: chr(int(m[1], 8)), line.split()[4])
+        for line in lines
+    }
+
+
+# 判斷規則本身改變時加一，讓舊的 repo_index.json 重新掃描
+PRUNE_RULES_VERSION = 2
+
+
+class PruneRules:
+    """掃描 repo 時要跳過的資料夾：exclude pattern、其他檔案系統、symlink 迴圈
+
+    符合 exclude pattern 但本身就是 repo 的資料夾（例如叫 build 的專案）還是會
+    列入，只是不往裡面掃。
+    """
+
+    def __init__(
+        self, bases: list[Path], patterns: list[str], one_file_system: bool
+    ) -> None:
+        self.bases = [str(b) for b in bases]
+        self.one_file_system = one_file_system
+        self.fingerprint = [PRUNE_RULES_VERSION, sorted(patterns), one_file_system]
+
+        name_patterns, path_patterns = [], []
+        for pattern in patterns:
+            pattern = pattern.strip().rstrip("/")
+            pattern = pattern.removeprefix("**/")
+            if not pattern or pattern.startswith("#"):
+                continue
+            if "/" in pattern:
+                path_patterns.append(pattern.lstrip("/"))
+            else:
+                name_patterns.append(pattern)
+        self.name_re = compile_globs(name_patterns)
+        self.path_re = compile_globs(path_patterns)
+
+        self.mounts = read_mount_points() if one_file_system else None
+        self.base_devs = set()
+        for base in self.bases:
+            with suppress(OSError):
+                self.base_devs.add(os.stat(base).st_dev)
+
+    def relative(self, path: str) -> str | None:
+        """path 相對於所屬允許路徑的部分"""
+        for base in self.bases:
+            if path.startswith(base.rstrip(os.sep) + os.sep):
+                return path[len(base.rstrip(os.sep)) + 1 :]
+        return None
+
+    def excluded(self, path: str, name: str) -> bool:
+        """是否符合 exclude pattern"""
+        if self.name_re and self.name_re.match(name):
+            return True
+        if self.path_re:
+            rel = self.relative(path)
+            return rel is not None and bool(self.path_re.match(rel))
+        return False
+
+    def is_mount(self, path: str) -> bool:
+        if not self.one_file_system:
+            return False
+        if self.mounts is not None:
+            return path in self.mounts
+        return os.path.ismount(path)
+
+    def link_ok(self, path: str, links: set[tuple[int, int]] | None) -> bool:
+        """symlink 資料夾：指回允許路徑內或已經走過的目標都跳過（避免迴圈與重複）"""
+        real = os.path.realpath(path)
+        if self.relative(real) is not None or real in self.bases:
+            return False
+        try:
+            st = os.stat(real)
+        except OSError:
+            return False
+        if self.one_file_system and st.st_dev not in self.base_devs:
+            return False
+        key = (st.st_dev, st.st_ino)
+        if links is not None:
+            if key in links:
+                return False
+            links.add(key)
+        return True
+
+    def allows_entry(
+        self, entry: os.DirEntry, links: set[tuple[int, int]] | None = None
+    ) -> bool:
+        """scandir 的子資料夾是否要往下掃"""
+        if self.excluded(entry.path, entry.name) and not is_repo_dir(entry.path):
+            return False
+        if entry.is_symlink():
+            return self.link_ok(entry.path, links)
+        return not self.is_mount(entry.path)
+
+    def allows_path(
+        self, path: str, links: set[tuple[int, int]] | None = None
+    ) -> bool:
+        """同 allows_entry，給沒有 DirEntry 的地方用（inotify 事件）"""
+        if self.excluded(path, os.path.basename(path)) and not is_repo_dir(path):
+            return False
+        if os.path.islink(path):
+            return self.link_ok(path, links)
+        return not self.is_mount(path)
+
+
+def is_repo_dir(path: str) -> bool:
+    """資料夾本身是不是 git repo（只在被 exclude 的資料夾上多 stat 一次）"""
+    return os.path.isdir(os.path.join(path, ".git"))
+
+
+def compile_globs(patterns: list[str]) -> re.Pattern | None:
+    """把多個 glob 合成一個 regex"""
+    if not patterns:
+        return None
+    return re.compile("|".join(fnmatch.translate(p) for p in patterns))
+
+
+prune = PruneRules(
+    config.allowed_paths, config.exclude_patterns, config.one_file_system
+)
+
+
+# scan_dir(路徑, 深度) -> (是否為 repo, 子資料夾名稱)；無法讀取時為 None
+DirScanner = Callable[[str, int], tuple[bool, list[str]] | None]
+
+
+def scan_dir(
+    path: str,
+    list_children: bool = True,
+    links: set[tuple[int, int]] | None = None,
+) -> tuple[bool, list[str]] | None:
+    """用 scandir 的 d_type 判斷 .git 與子資料夾，不用對每個子項目 stat"""
+    if not list_children:
+        return os.path.isdir(os.path.join(path, ".git")), []
+    is_repo = False
+    pruned = False
+    children = []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                name = entry.name
+                if name == ".git":
+                    is_repo = entry.is_dir()
+                elif name in PRUNE_MARKERS:
+                    pruned = True
+                elif (
+                    not name.startswith(".")
+                    and entry.is_dir()
+                    and prune.allows_entry(entry, links)
+                ):
+                    children.append(name)
+    except OSError:
+        return None
+    if is_repo:
+        return True, []
+    return False, [] if pruned else sorted(children)
+
+
+# 每個 thread pool 工作最多連續掃幾個資料夾，避免每個資料夾一個 future 的開銷
+WALK_BATCH = 64
+
+WalkResult = tuple[str, int, bool, list[str]]
+
+
+def walk_batch(
+    stack: list[tuple[str, int]], scan: DirScanner
+) -> tuple[list[WalkResult], list[tuple[str, int]]]:
+    """從 stack 深度優先掃最多 WALK_BATCH 個資料夾，回傳結果與還沒掃的資料夾"""
+    results = []
+    while stack and len(results) < WALK_BATCH:
+        path, depth = stack.pop()
+        found = scan(path, depth)
+        if found is None:
+            continue
+        is_repo, children = found
+        results.append((path, depth, is_repo, children))
+        # repo 底下不再往下走
+        if not is_repo:
+            stack.extend((os.path.join(path, n), depth + 1) for n in reversed(children))
+    return results, stack
+
+
+def walk_tree(base: str, scan: DirScanner, workers: int = 8) -> Iterator[WalkResult]:
+    """用 thread pool 平行走訪資料夾
+
+    每掃完一批就 yield (路徑, 深度, 是否為 repo, 子資料夾)；
+    呼叫端中途停止時會取消還沒開始的掃描。
+    """
+    pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="repo-scan")
+    try:
+        pending = {pool.submit(walk_batch, [(base, 0)], scan)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                results, leftover = future.result()
+                # 先把剩下的資料夾分給閒著的 worker，再把結果交給呼叫端
+                parts = max(1, min(workers - len(pending), len(leftover)))
+                for i in range(parts if leftover else 0):
+                    pending.add(pool.submit(walk_batch, leftover[i::parts], scan))
+                yield from results
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def iter_git_repos(
+    base_path: Path, max_depth: int = 3, workers: int = 8
+) -> Iterator[Path]:
+    """平行尋找 git repositories，找到就 yield（順序不固定）"""
+    links: set[tuple[int, int]] = set()
+
+    def scan(path: str, depth: int) -> tuple[bool, list[str]] | None:
+        return scan_dir(path, depth < max_depth, links)
+
+    for path, _, is_repo, _ in walk_tree(str(base_path), scan, workers):
+        if is_repo:
+            yield Path(path)
+
+
+def find_git_repos(base_path: Path, max_depth: int = 3) -> list[Path]:
+    """遞迴尋找 git repositories"""
+    return sorted(iter_git_repos(base_path, max_depth, config.scan_workers))
+
+
+def first_git_repos(limit: int) -> list[Path]:
+    """在所有允許路徑找到前 limit 個 repo 就停止掃描"""
+    repos = []
+    for base in config.allowed_paths:
+        if len(repos) >= limit:
+            break
+        if base.exists():
+            found = iter_git_repos(base, workers=config.scan_workers)
+            repos.extend(itertools.islice(found, limit - len(repos)))
+    return repos
+
+
+# ============================================================
+# Repo 索引
+# ============================================================
+
+
+class RepoIndex:
+    """持久化的 repo 索引，重掃時只重新列出 mtime 有變的資料夾"""
+
+    def __init__(self, path: Path, max_depth: int = 3) -> None:
+        self.path = path
+        self.max_depth = max_depth
+        # base -> {資料夾: [mtime_ns, 是否為 repo, 子資料夾名稱]}
+        self.dirs: dict[str, dict[str, list]] = {}
+        self.lock = threading.Lock()
+        self.version = 0  # 內容有變就加一
+
+    def load(self) -> None:
+        """讀取上次存下來的索引（不存在或壞掉就從頭掃）"""
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            # 掃描規則改了，舊的子資料夾清單就不能用
+            if data.get("max_depth") == self.max_depth and (
+                data.get("prune") == prune.fingerprint
+            ):
+                self.dirs = data["bases"]
+                self.version += 1
+        except (OSError, ValueError, KeyError):
+            self.dirs = {}
+
+    def save(self) -> None:
+        """寫到暫存檔再換名，避免寫到一半的索引"""
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp, "w") as f:
+            json.dump(
+                {
+                    "max_depth": self.max_depth,
+                    "prune": prune.fingerprint,
+                    "bases": self.dirs,
+                },
+                f,
+            )
+        os.replace(tmp, self.path)
+
+    def repos(self, base: Path) -> list[Path] | None:
+        """索引中 base 底下的 repo；還沒掃描過時回傳 None"""
+        dirs = self.dirs.get(str(base))
+        if dirs is None:
+            return None
+        return sorted(Path(p) for p, (_, is_repo, _) in dirs.items() if is_repo)
+
+    def all_repos(self) -> list[Path] | None:
+        """所有允許路徑底下的 repo；有任何一個還沒掃描過時回傳 None"""
+        repos = []
+        for base in config.allowed_paths:
+            found = self.repos(base)
+            if found is None:
+                return None
+            repos.extend(found)
+        return repos
+
+    def scan(self, base: Path) -> list[Path]:
+        """增量掃描 base：mtime 沒變的資料夾沿用上次的子資料夾清單"""
+        old = self.dirs.get(str(base), {})
+        mtimes: dict[str, int] = {}
+        links: set[tuple[int, int]] = set()
+
+        def scan(path: str, depth: int) -> tuple[bool, list[str]] | None:
+            try:
+                mtimes[path] = os.stat(path).st_mtime_ns
+            except OSError:
+                return None
+            entry = old.get(path)
+            if entry and entry[0] == mtimes[path]:
+                # 新增、刪除子項目（包括 .git）都會改變資料夾的 mtime
+                return entry[1], entry[2]
+            return scan_dir(path, depth < self.max_depth, links)
+
+        seen = {
+            path: [mtimes[path], is_repo, children]
+            for path, _, is_repo, children in walk_tree(
+                str(base), scan, config.scan_workers
+            )
+        }
+        self.dirs[str(base)] = seen
+        return self.repos(base)
+
+    def refresh(self) -> list[Path]:
+        """重掃所有允許路徑並存檔（在 thread 裡執行）"""
+        with self.lock:
+            before = dict(self.dirs)
+            repos = []
+            for base in config.allowed_paths:
+                if base.exists():
+                    repos.extend(self.scan(base))
+                else:
+                    self.dirs[str(base)] = {}
+            if self.dirs != before:
+                self.version += 1
+                self.save()
+            return repos
+
+
+repo_index = RepoIndex(REPO_INDEX_FILE)
+repo_index.load()
+
+
+async def refresh_repo_index() -> list[Path]:
+    """在背景 thread 重掃 repo 索引"""
+    return await asyncio.to_thread(repo_index.refresh)
+
+
+def indexed_repos() -> list[Path] | None:
+    """即時監看或持久化索引中的 repo（不碰檔案系統）；都還沒有時回傳 None"""
+    if repo_watcher.active:
+        return repo_watcher.snapshot()
+    return repo_index.all_repos()
+
+
+async def known_repos() -> list[Path]:
+    """從索引取得 repo 清單，索引還沒建立時才實際掃描"""
+    repos = indexed_repos()
+    if repos is None:
+        repos = await refresh_repo_index()
+    return repos
+
+
+async def rescan_periodically() -> None:
+    """沒有 inotify 可用時，定期增量重掃索引"""
+    while True:
+        await asyncio.sleep(config.rescan_interval)
+        try:
+            await refresh_repo_index()
+        except Exception:
+            logger.exception("repo index rescan failed")
+
+
+# ============================================================
+# 即時 repo 監看（Linux inotify）
+# ============================================================
+
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_ONLYDIR
+
+INOTIFY_EVENT = struct.Struct("iIII")  # wd, mask, cookie, len
+
+
+# 要在 thread 裡走訪的資料夾：(路徑, 深度, 是否要替它本身加 watch)
+WatchRoot = tuple[str, int, bool]
+
+
+class RepoWatcher:
+    """用 inotify 監看允許路徑（到 max_depth 為止），即時維護 repo 清單
+
+    走訪資料夾、加 watch 都在 thread 裡做，結果回到 event loop 才寫進狀態；
+    走訪進行中收到的事件先排著，套用完結果後依序處理，所以事件不會看到
+    還沒登記的 watch，也不會和走訪的結果交錯。
+    """
+
+    def __init__(self, max_depth: int = 3) -> None:
+        self.max_depth = max_depth
+        self.fd = -1
+        self.libc = None
+        self.watches: dict[int, tuple[str, int]] = {}  # wd -> (路徑, 深度)
+        self.paths: dict[str, int] = {}  # 路徑 -> wd
+        self.repos: set[str] = set()
+        self.links: set[tuple[int, int]] = set()
+        self.active = False
+        self.version = 0  # 每批事件加一，讓 repo 名稱索引知道要重建
+        self.events: deque[tuple[int, int, str]] = deque()
+        self.walk: asyncio.Task | None = None  # 進行中的背景走訪
+
+    def snapshot(self) -> list[Path]:
+        return sorted(Path(p) for p in self.repos)
+
+    async def start(self) -> None:
+        """建立 watch；不支援或 watch 數量不夠時改成定期重掃"""
+        try:
+            self.libc = ctypes.CDLL(None, use_errno=True)
+            self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if self.fd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+            found = await asyncio.to_thread(self.collect, self.base_roots(), [])
+        except (AttributeError, OSError) as e:
+            logger.warning(f"inotify 無法使用，改為每 {config.rescan_interval} 秒重掃: {e}")
+            self.close()
+            asyncio.get_running_loop().create_task(rescan_periodically())
+            return
+
+        self.apply(*found)
+        asyncio.get_running_loop().add_reader(self.fd, self.on_readable)
+        self.active = True
+        logger.info(f"👀 inotify 監看 {len(self.watches)} 個資料夾")
+
+    def close(self) -> None:
+        self.active = False
+        if self.walk:
+            self.walk.cancel()
+            self.walk = None
+        if self.fd >= 0:
+            with suppress(Exception):
+                asyncio.get_running_loop().remove_reader(self.fd)
+            os.close(self.fd)
+        self.fd = -1
+        self.watches.clear()
+        self.paths.clear()
+        self.repos.clear()
+        self.events.clear()
+
+    @staticmethod
+    def base_roots() -> list[WatchRoot]:
+        return [(str(base), 0, True) for base in config.allowed_paths]
+
+    def collect(
+        self, roots: list[WatchRoot], remove: list[int]
+    ) -> tuple[list[tuple[int, str, int]], list[str]]:
+        """（thread 裡執行）移除舊的 watch，從 roots 往下加 watch
+
+        回傳 ([(wd, 路徑, 深度)], [repo])；不碰 self 的狀態，只有 links 是共用的。
+        watch 數量不夠時丟出 OSError。
+        """
+        for wd in remove:
+            self.libc.inotify_rm_watch(self.fd, wd)
+        watches, repos = [], []
+        # 事件裡新出現的資料夾還沒經過 exclude / mount / symlink 的檢查
+        stack = [
+            root
+            for root in reversed(roots)
+            if root[1] == 0 or not root[2] or prune.allows_path(root[0], self.links)
+        ]
+        while stack:
+            path, depth, add = stack.pop()
+            if add:
+                wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+                if wd < 0:
+                    err = ctypes.get_errno()
+                    if err in (errno.ENOSPC, errno.ENOMEM):
+                        raise OSError(err, "inotify watch limit reached")
+                    continue  # 資料夾剛好被刪掉、沒有權限或不存在
+                watches.append((wd, path, depth))
+
+            # 是 repo 就只看它自己（等 .git 被刪），否則往下
+            found = scan_dir(path, depth < self.max_depth, self.links)
+            if found is None:
+                continue
+            is_repo, children = found
+            if is_repo:
+                repos.append(path)
+            stack.extend(
+                (os.path.join(path, name), depth + 1, True)
+                for name in reversed(children)
+            )
+        return watches, repos
+
+    def apply(self, watches: list[tuple[int, str, int]], repos: list[str]) -> None:
+        """把 collect() 的結果寫進狀態（event loop 上）"""
+        for wd, path, depth in watches:
+            self.watches[wd] = (path, depth)
+            self.paths[path] = wd
+        self.repos.update(repos)
+        self.version += 1
+
+    def start_walk(
+        self, roots: list[WatchRoot], remove: list[int] | None = None
+    ) -> None:
+        """在背景走訪 roots；完成前收到的事件先排隊"""
+        self.walk = asyncio.get_running_loop().create_task(
+            self.run_walk(roots, remove or [])
+        )
+
+    async def run_walk(self, roots: list[WatchRoot], remove: list[int]) -> None:
+        try:
+            found = await asyncio.to_thread(self.collect, roots, remove)
+        except OSError as e:
+            self.fall_back(e)
+            return
+        self.walk = None
+        self.apply(*found)
+        self.process_events()
+
+    def fall_back(self, error: OSError) -> None:
+        logger.warning(f"inotify watch 不足，改為定期重掃: {error}")
+        self.walk = None
+        self.close()
+        asyncio.get_running_loop().create_task(rescan_periodically())
+
+    def unwatch_tree(self, path: str, keep_root: bool = False) -> None:
+        """停止監看 path 底下（含 path 本身，除非 keep_root）的資料夾"""
+        prefix = path + os.sep
+        for p in [p for p in self.paths if p.startswith(prefix) or p == path]:
+            if keep_root and p == path:
+                continue
+            wd = self.paths.pop(p)
+            self.watches.pop(wd, None)
+            self.libc.inotify_rm_watch(self.fd, wd)
+        self.repos = {
+            r
+            for r in self.repos
+            if not (r.startswith(prefix) or (r == path and not keep_root))
+        }
+
+    def on_readable(self) -> None:
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        self.version += 1
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, size = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = data[offset : offset + size].rstrip(b"\0")
+            offset += size
+            self.events.append((wd, mask, os.fsdecode(name)))
+        self.process_events()
+
+    def process_events(self) -> None:
+        """依序處理排隊的事件，遇到需要背景走訪的就先停下"""
+        while self.events and self.walk is None and self.active:
+            self.handle_event(*self.events.popleft())
+
+    def handle_event(self, wd: int, mask: int, name: str) -> None:
+        if mask & IN_Q_OVERFLOW:
+            # 事件掉了，整個重建；之前排著的事件都已經沒有意義
+            old = list(self.watches)
+            self.watches.clear()
+            self.paths.clear()
+            self.repos.clear()
+            self.links.clear()
+            self.events.clear()
+            self.start_walk(self.base_roots(), old)
+            return
+        if mask & IN_IGNORED:
+            path, _ = self.watches.pop(wd, (None, 0))
+            if path and self.paths.get(path) == wd:
+                del self.paths[path]
+            return
+        if wd not in self.watches or not mask & IN_ISDIR:
+            return
+
+        parent, depth = self.watches[wd]
+        path = os.path.join(parent, name)
+        created = mask & (IN_CREATE | IN_MOVED_TO)
+
+        if name == ".git":
+            if created:
+                # 變成 repo：不再往下看
+                self.unwatch_tree(parent, keep_root=True)
+                self.repos.add(parent)
+            else:
+                # 不再是 repo：重新看它底下的資料夾（parent 本身已經有 watch）
+                self.repos.discard(parent)
+                self.start_walk([(parent, depth, False)])
+        elif name.startswith("."):
+            return
+        elif created:
+            if parent not in self.repos and depth < self.max_depth:
+                self.start_walk([(path, depth + 1, True)])
+        else:
+            self.unwatch_tree(path)
+
+
+repo_watcher = RepoWatcher()
+
+
+# ============================================================
+# Repo 名稱查詢
+# ============================================================
+
+
+def trigrams(text: str) -> set[str]:
+    return {text[i : i + 3] for i in range(len(text) - 2)}
+
+
+class RepoNames:
+    """用 repo 名稱或路徑結尾找 repo：完全符合查 dict，部分符合用 trigram 縮小範圍"""
+
+    def __init__(self) -> None:
+        self.key: tuple | None = None
+        self.repos: list[Path] = []
+        self.names: list[str] = []  # 小寫的資料夾名稱
+        self.rels: list[str] = []  # 小寫、相對於允許路徑的路徑
+        self.suffixes: dict[str, list[int]] = {}  # "api"、"acme/api" -> repo
+        self.grams: dict[str, set[int]] = {}
+
+    @staticmethod
+    def relative(path: str) -> str:
+        """小寫、相對於所屬允許路徑的路徑（不在允許路徑內就原樣）"""
+        for base in config.allowed_paths:
+            prefix = str(base).rstrip(os.sep) + os.sep
+            if path.startswith(prefix):
+                return path[len(prefix) :].lower()
+        return path.lower()
+
+    def build(self, repos: list[Path], key: tuple) -> None:
+        self.key = key
+        self.repos = repos
+        self.names, self.rels = [], []
+        self.suffixes, self.grams = {}, {}
+        for i, repo in enumerate(repos):
+            rel = self.relative(str(repo))
+            parts = rel.split(os.sep)
+            self.names.append(parts[-1])
+            self.rels.append(rel)
+            for n in range(1, len(parts) + 1):
+                self.suffixes.setdefault("/".join(parts[-n:]), []).append(i)
+            for gram in trigrams(rel):
+                self.grams.setdefault(gram, set()).add(i)
+
+    def candidates(self, query: str) -> set[int] | range:
+        """含有 query 所有 trigram 的 repo"""
+        grams = trigrams(query)
+        if not grams:
+            return range(len(self.repos))
+        sets = sorted((self.grams.get(g, set()) for g in grams), key=len)
+        return set.intersection(*sets)
+
+    def lookup(self, query: str) -> list[Path]:
+        """名稱或路徑結尾完全符合優先，否則找名稱（或含 / 時的路徑）包含 query 的"""
+        query = query.strip("/").lower()
+        if not query:
+            return []
+        exact = self.suffixes.get(query)
+        if exact:
+            return [self.repos[i] for i in exact]
+        fields = self.rels if "/" in query else self.names
+        hits = sorted(i for i in self.candidates(query) if query in fields[i])
+        return [self.repos[i] for i in hits]
+
+    def search(self, query: str) -> list[Path]:
+        """路徑（相對於允許路徑）包含 query 的 repo"""
+        query = query.lower()
+        hits = sorted(i for i in self.candidates(query) if query in self.rels[i])
+        return [self.repos[i] for i in hits]
+
+    def suggest(self, query: str, limit: int = 5) -> list[Path]:
+        """打錯的路徑或名稱最像哪些 repo
+
+        先用共同 trigram 數挑出候選，再用 difflib 比對名稱與路徑排序。
+        """
+        if is_path_like(query):
+            query = os.path.expanduser(query)
+        rel = self.relative(query).strip("/")
+        name = rel.rsplit("/", 1)[-1]
+        shared: dict[int, int] = {}
+        for gram in trigrams(rel):
+            for i in self.grams.get(gram, ()):
+                shared[i] = shared.get(i, 0) + 1
+        if not shared:
+            return []
+        top = sorted(shared, key=shared.__getitem__, reverse=True)[: limit * 8]
+
+        def score(i: int) -> float:
+            by_name = difflib.SequenceMatcher(None, name, self.names[i]).ratio()
+            by_path = difflib.SequenceMatcher(None, rel, self.rels[i]).ratio()
+            return (by_name + by_path) / 2
+
+        ranked = sorted(((score(i), i) for i in top), key=lambda x: (-x[0], x[1]))
+        return [self.repos[i] for s, i in ranked[:limit] if s >= 0.3]
+
+
+repo_names = RepoNames()
+
+
+async def known_repo_names() -> RepoNames:
+    """取得最新的 repo 名稱索引，repo 清單有變才重建"""
+    if repo_watcher.active:
+        key = ("watch", repo_watcher.version)
+    else:
+        key = ("index", repo_index.version)
+    if repo_names.key != key:
+        repos = await known_repos()
+        # known_repos 可能剛重掃過，版本要重新讀
+        version = repo_watcher.version if repo_watcher.active else repo_index.version
+        repo_names.build(repos, (key[0], version))
+    return repo_names
+
+
+def is_path_like(text: str) -> bool:
+    """~、/、. 開頭的當作路徑，其他的當作 repo 名稱"""
+    return text.startswith(("~", "/", "."))
+
+
+# ============================================================
+# Git 執行
+# ============================================================
+
+
+class SpoolFile:
+    """完整輸出的暫存檔，所有使用者都 release 之後刪除"""
+
+    def __init__(self, max_bytes: int) -> None:
+        fd, name = tempfile.mkstemp(prefix="git-bot-", suffix=".txt")
+        self.path = Path(name)
+        self.file = os.fdopen(fd, "wb")
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.truncated = False
+        self.refs = 1
+
+    def write(self, data: bytes | bytearray) -> None:
+        room = self.max_bytes - self.size
+        if len(data) > room:
+            self.truncated = True
+            data = data[:room]
+        self.file.write(data)
+        self.size += len(data)
+
+    def close(self) -> None:
+        self.file.close()
+
+    def retain(self) -> None:
+        self.refs += 1
+
+    def release(self) -> None:
+        self.refs -= 1
+        if self.refs <= 0:
+            self.file.close()
+            self.path.unlink(missing_ok=True)
+
+
+@dataclass
+class GitResult:
+    """Git 指令執行結果"""
+
+    success: bool
+    output: str
+    return_code: int
+    error: str | None = None
+    cut_early: bool = False
+    document: SpoolFile | None = None
+    rejected: bool = False  # 驗證沒過、沒有執行；error 是要直接回覆的訊息
+
+
+# 不會修改 repo 的指令，可在同一個 repo 平行執行
+READ_ONLY_COMMANDS = {"status", "log", "diff", "show", "branch"}
+
+# git branch 只列出分支時可用的參數；其他參數（包括 git 接受的長參數縮寫）
+# 一律當作可能修改 repo，寧可少平行、少快取，也不要把寫入當成讀取
+BRANCH_READ_ONLY_SHORT = set("alrvqi")
+BRANCH_READ_ONLY_LONG = {
+    "--all", "--remotes", "--list", "--verbose", "--quiet", "--ignore-case",
+    "--show-current", "--contains", "--no-contains", "--merged", "--no-merged",
+    "--points-at", "--sort", "--format", "--color", "--no-color", "--column",
+    "--no-column", "--abbrev", "--no-abbrev", "--omit-empty",
+}  # fmt: skip
+
+# 出現時 git branch 一定是列表模式，之後的 positional 參數是 pattern
+BRANCH_LIST_SHORT = set("alr")
+BRANCH_LIST_LONG = {
+    "--all", "--remotes", "--list",
+    "--contains", "--no-contains", "--merged", "--no-merged", "--points-at",
+}  # fmt: skip
+
+
+def is_read_only_command(git_cmd: str) -> bool:
+    """判斷 git 指令是否不會修改 repo（用和執行時相同的 shlex 切法）"""
+    try:
+        args = shlex.split(git_cmd)
+    except ValueError:
+        return False
+    if not args or args[0] not in READ_ONLY_COMMANDS:
+        return False
+    if args[0] != "branch":
+        return True
+
+    list_mode = False
+    has_positional = False
+    for arg in args[1:]:
+        if arg.startswith("--"):
+            name = arg.split("=", 1)[0]
+            if name not in BRANCH_READ_ONLY_LONG:
+                return False
+            list_mode |= name in BRANCH_LIST_LONG
+        elif arg.startswith("-") and arg != "-":
+            # 短參數可以合併，例如 -av；每個字母都要在允許清單裡
+            letters = set(arg[1:])
+            if not letters <= BRANCH_READ_ONLY_SHORT:
+                return False
+            list_mode |= bool(letters & BRANCH_LIST_SHORT)
+        else:
+            has_positional = True
+    return not has_positional or list_mode
+
+
+class RepoLock:
+    """單一 repo 的讀寫鎖（寫入優先，避免 writer 餓死）"""
+
+    def __init__(self) -> None:
+        self.cond = asyncio.Condition()
+        self.readers = 0
+        self.writing = False
+        self.waiting_writers = 0
+        self.holders = 0
+
+    @asynccontextmanager
+    async def read(self):
+        async with self.cond:
+            await self.cond.wait_for(
+                lambda: not self.writing and not self.waiting_writers
+            )
+            self.readers += 1
+        try:
+            yield
+        finally:
+            async with self.cond:
+                self.readers -= 1
+                self.cond.notify_all()
+
+    @asynccontextmanager
+    async def write(self):
+        async with self.cond:
+            self.waiting_writers += 1
+            try:
+                await self.cond.wait_for(
+                    lambda: not self.writing and not self.readers
+                )
+            finally:
+                self.waiting_writers -= 1
+            self.writing = True
+        try:
+            yield
+        finally:
+            async with self.cond:
+                self.writing = False
+                self.cond.notify_all()
+
+
+class RepoLockManager:
+    """以 resolved repo 路徑為 key 管理讀寫鎖"""
+
+    def __init__(self) -> None:
+        self.locks: dict[Path, RepoLock] = {}
+
+    @asynccontextmanager
+    async def acquire(self, path: Path, read_only: bool):
+        """唯讀指令共用讀鎖，會修改 repo 的指令獨佔寫鎖"""
+        key = await asyncio.to_thread(path.resolve)
+        lock = self.locks.setdefault(key, RepoLock())
+        lock.holders += 1
+        try:
+            async with lock.read() if read_only else lock.write():
+                yield
+        finally:
+            lock.holders -= 1
+            if not lock.holders:
+                del self.locks[key]
+
+
+repo_locks = RepoLockManager()
+
+
+def kill_process_group(proc: asyncio.subprocess.Process) -> None:
+    """終止子程序所屬的整個 process group"""
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+# 支援 --progress 的指令，即時回報時自動加上
+PROGRESS_COMMANDS = {"fetch", "pull", "push", "clone"}
+
+# 例: "Receiving objects:  45% (450/1000), 1.20 MiB | 2.00 MiB/s"
+PROGRESS_RE = re.compile(
+    r"^(?:remote: )?(?P<stage>[A-Za-z][\w ]*?):\s+(?P<percent>\d{1,3})%"
+)
+
+# 即時預覽只顯示輸出的最後幾個字元
+STREAM_PREVIEW_CHARS = 1000
+
+# on_output(目前輸出的尾端, 進度行)
+OutputCallback = Callable[[str, str | None], None]
+
+
+def with_progress_flag(args: list[str]) -> list[str]:
+    """在支援的指令後面加上 --progress"""
+    if not args or args[0] not in PROGRESS_COMMANDS or "--progress" in args:
+        return args
+    return [args[0], "--progress", *args[1:]]
+
+
+def parse_git_progress(stderr: str) -> str | None:
+    """從 stderr 找出最新的進度，轉成進度條"""
+    for line in reversed(re.split(r"[\r\n]", stderr)):
+        match = PROGRESS_RE.match(line.strip())
+        if match:
+            percent = min(int(match["percent"]), 100)
+            bar = "▓" * (percent // 10) + "░" * (10 - percent // 10)
+            return f"{match['stage']} {bar} {percent}%"
+    return None
+
+
+def strip_progress_lines(text: str) -> str:
+    """移除 --progress 產生的進度行"""
+    lines = (line.rsplit("\r", 1)[-1] for line in text.split("\n"))
+    return "\n".join(line for line in lines if not PROGRESS_RE.match(line.strip()))
+
+
+def decode_tail(data: bytes | bytearray, chars: int) -> str:
+    """只解碼最後一段 bytes（可能切在 UTF-8 字元中間）"""
+    return bytes(data[-chars * 4 :]).decode(errors="replace").lstrip("\ufffd")[-chars:]
+
+
+def decode_head(data: bytes | bytearray, chars: int) -> str:
+    """只解碼開頭一段 bytes（可能切在 UTF-8 字元中間）"""
+    return bytes(data[: chars * 4]).decode(errors="replace")[:chars].rstrip("\ufffd")
+
+
+class OutputSpool:
+    """固定大小的輸出緩衝：保留開頭與結尾各 limit bytes，中間只計算長度"""
+
+    def __init__(self, limit: int, spill_limit: int = 0) -> None:
+        self.limit = limit
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.total = 0
+        self.truncated = False
+        # spill_limit > 0 時，超過 head 的輸出會完整寫進暫存檔
+        self.spill_limit = spill_limit
+        self.spill: SpoolFile | None = None
+
+    def __bool__(self) -> bool:
+        return self.total > 0
+
+    def write(self, chunk: bytes) -> None:
+        if self.spill:
+            self.spill.write(chunk)
+        elif self.spill_limit and self.total + len(chunk) > self.limit:
+            # 到目前為止的輸出都還在 head 裡，一起寫進暫存檔
+            self.spill = SpoolFile(self.spill_limit)
+            self.spill.write(self.head)
+            self.spill.write(chunk)
+
+        self.total += len(chunk)
+        room = self.limit - len(self.head)
+        if room > 0:
+            self.head.extend(chunk[:room])
+        self.tail.extend(chunk[-self.limit :])
+        if len(self.tail) > self.limit:
+            del self.tail[: len(self.tail) - self.limit]
+
+    def to_file(self) -> SpoolFile | None:
+        """取得完整輸出的暫存檔（輸出都在 head 裡時才建立）"""
+        if self.spill is None and self.spill_limit and self.total:
+            self.spill = SpoolFile(self.spill_limit)
+            self.spill.write(self.head)
+        if self.spill:
+            self.spill.close()
+        return self.spill
+
+    def discard(self) -> None:
+        """丟掉暫存檔"""
+        if self.spill:
+            self.spill.release()
+            self.spill = None
+
+    def render(
+        self, mode: str, chars: int, clean: Callable[[str], str] | None = None
+    ) -> str:
+        """依 head / tail / both 模式，只解碼要送出的那一段"""
+        clean = clean or (lambda text: text)
+
+        self.truncated = True
+        if self.total <= self.limit:
+            text = clean(self.head.decode(errors="replace")).strip()
+            if len(text) <= chars:
+                self.truncated = False
+                return text
+            head, tail = text, text
+        else:
+            head = clean(decode_head(self.head, chars)).lstrip()
+            tail = clean(decode_tail(self.tail, chars)).rstrip()
+
+        if mode == "tail":
+            return "(已截斷) ...\n" + tail[-chars:].lstrip()
+        if mode == "both":
+            half = chars // 2
+            head, tail = head[:half].rstrip(), tail[-half:].lstrip()
+            skipped = self.total - len(head.encode()) - len(tail.encode())
+            return f"{head}\n... (省略 {skipped} bytes) ...\n{tail}"
+        return head[:chars].rstrip() + "\n... (已截斷)"
+
+
+# git 執行檔與環境變數只在啟動時計算一次
+GIT_BIN = shutil.which("git") or "git"
+GIT_ENV = {**os.environ, "GIT_TERMINAL_PROMPT": "0"}
+# 唯讀指令不要去搶 index.lock（例如 status 順手更新 index）
+GIT_READ_ONLY_ENV = {**GIT_ENV, "GIT_OPTIONAL_LOCKS": "0"}
+
+
+async def execute_git_command(
+    path: Path, git_cmd: str, on_output: OutputCallback | None = None
+) -> GitResult:
+    """在指定路徑執行 git 指令（不阻塞 event loop）"""
+    read_only = is_read_only_command(git_cmd)
+    env = GIT_READ_ONLY_ENV if read_only else GIT_ENV
+
+    async with repo_locks.acquire(path, read_only):
+        key = await result_cache.key_for(path, git_cmd) if read_only else None
+        # 只有唯讀指令可以中途砍掉，寫入中的 pull / commit 不能中斷
+        result = await run_git_process(
+            path, git_cmd, env, on_output, stoppable=read_only
+        )
+
+    if not read_only:
+        result_cache.invalidate(path)
+    elif key and not result.error and not result.document:
+        result_cache.put(key, result)
+    return result
+
+
+async def run_git_process(
+    path: Path,
+    git_cmd: str,
+    env: dict[str, str],
+    on_output: OutputCallback | None = None,
+    stoppable: bool = False,
+) -> GitResult:
+    """直接 exec git（不經過 shell），邊讀邊回報輸出"""
+    try:
+        args = shlex.split(git_cmd)
+    except ValueError as e:
+        return GitResult(
+            success=False,
+            output="",
+            return_code=-1,
+            error=f"無法解析指令: {e}",
+        )
+    if on_output:
+        args = with_progress_flag(args)
+
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            GIT_BIN,
+            *args,
+            cwd=str(path),
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            env=env,
+            start_new_session=True,
+        )
+    except Exception as e:
+        return GitResult(
+            success=False,
+            output="",
+            return_code=-1,
+            error=str(e),
+        )
+
+    # 每個 stream 最多保留開頭、結尾各 max_output_length 個字元的 bytes
+    limit = max(config.max_output_length, STREAM_PREVIEW_CHARS) * 4
+    spill_limit = config.max_document_bytes if config.send_overflow_document else 0
+    stdout = OutputSpool(limit, spill_limit)
+    stderr = OutputSpool(limit)
+
+    def notify() -> None:
+        if stdout:
+            preview = decode_tail(stdout.tail, STREAM_PREVIEW_CHARS)
+        else:
+            preview = strip_progress_lines(
+                decode_tail(stderr.tail, STREAM_PREVIEW_CHARS)
+            )
+        on_output(preview.strip(), parse_git_progress(decode_tail(stderr.tail, 512)))
+
+    cut_early = False
+
+    def over_budget() -> bool:
+        """之後的輸出已經不會被看到（或超過 byte 預算）"""
+        if config.output_byte_budget and (
+            stdout.total + stderr.total > config.output_byte_budget
+        ):
+            return True
+        # tail / both 模式需要讀到最後，只有 head 模式能提早停；
+        # 要上傳完整輸出時也得讀完
+        return (
+            config.stop_at_output_cap
+            and config.output_mode == "head"
+            and not config.send_overflow_document
+            and len(stdout.head) >= stdout.limit
+        )
+
+    async def pump(stream: asyncio.StreamReader, spool: OutputSpool) -> None:
+        nonlocal cut_early
+        while chunk := await stream.read(65536):
+            spool.write(chunk)
+            if on_output:
+                notify()
+            if stoppable and not cut_early and over_budget():
+                cut_early = True
+                kill_process_group(proc)
+
+    try:
+        await asyncio.wait_for(
+            asyncio.gather(
+                pump(proc.stdout, stdout), pump(proc.stderr, stderr), proc.wait()
+            ),
+            timeout=config.command_timeout,
+        )
+    except TimeoutError:
+        kill_process_group(proc)
+        await proc.wait()
+        stdout.discard()
+        return GitResult(
+            success=False,
+            output="",
+            return_code=-1,
+            error=f"超時 ({config.command_timeout}秒)",
+        )
+    except asyncio.CancelledError:
+        kill_process_group(proc)
+        stdout.discard()
+        raise
+
+    chars = config.max_output_length
+    output = stdout.render(config.output_mode, chars)
+    if not output and on_output:
+        # 有用的訊息（From ...、分支更新）在一長串進度行之後
+        output = stderr.render("tail", chars, clean=strip_progress_lines)
+    elif not output:
+        output = stderr.render(config.output_mode, chars)
+
+    document = None
+    if stdout.truncated:
+        document = stdout.to_file()
+    else:
+        stdout.discard()
+
+    return GitResult(
+        success=proc.returncode == 0 or cut_early,
+        output=output or "(無輸出)",
+        return_code=proc.returncode,
+        cut_early=cut_early,
+        document=document,
+    )
+
+
+# ============================================================
+# 結果快取
+# ============================================================
+
+# 輸出會受工作目錄影響的指令（改檔案不會動到 index / refs），快取時間較短
+WORKTREE_COMMANDS = {"status", "diff"}
+
+
+def file_stamp(path: str) -> tuple[int, int] | None:
+    """檔案的 (mtime_ns, size)，不存在時為 None"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+def read_small_file(path: str) -> str:
+    """讀取 HEAD、ref 這類很小的檔案"""
+    with open(path) as f:
+        return f.read().strip()
+
+
+def repo_state_key(path: Path) -> tuple | None:
+    """以 HEAD oid、index 與 refs 的 stat 代表 repo 目前的狀態"""
+    # 這裡每個指令都會跑一次，用字串路徑省掉 Path 物件的開銷
+    git_dir = os.path.join(path, ".git")
+    try:
+        head = read_small_file(os.path.join(git_dir, "HEAD"))
+    except OSError:
+        return None
+    oid = head
+    if head.startswith("ref: "):
+        # 只存在 packed-refs 裡的 branch 由 packed-refs 的 stat 代表
+        with suppress(OSError):
+            oid = read_small_file(os.path.join(git_dir, head[5:]))
+
+    return (
+        oid,
+        file_stamp(os.path.join(git_dir, "index")),
+        file_stamp(os.path.join(git_dir, "packed-refs")),
+        ref_dir_stamps(os.path.join(git_dir, "refs")),
+    )
+
+
+def ref_dir_stamps(refs_dir: str) -> tuple:
+    """refs/ 底下每一層目錄的 stat
+
+    更新 ref 是寫 <ref>.lock 再 rename，會改到 ref 所在目錄的 mtime；
+    feature/x、origin/feature/x 這類 ref 在子目錄裡，所以每一層都要算。
+    """
+    stamps = []
+    pending = [refs_dir]
+    while pending:
+        current = pending.pop()
+        stamps.append((current, file_stamp(current)))
+        try:
+            with os.scandir(current) as it:
+                pending.extend(e.path for e in it if e.is_dir(follow_symlinks=False))
+        except OSError:
+            pass
+    return tuple(sorted(stamps))
+
+
+class ResultCache:
+    """唯讀指令結果的 LRU + TTL 快取，key 包含 repo 狀態"""
+
+    def __init__(self, max_entries: int, ttl: float, worktree_ttl: float) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.worktree_ttl = worktree_ttl
+        self.entries: OrderedDict[tuple, tuple[float, GitResult]] = OrderedDict()
+
+    def make_key(self, path: Path, git_cmd: str) -> tuple | None:
+        """(repo, 正規化的 argv, repo 狀態)；無法快取時回傳 None
+
+        會讀 repo 的 HEAD 與 refs，在 event loop 上請用 key_for()。
+        """
+        if self.ttl <= 0 or not is_read_only_command(git_cmd):
+            return None
+        try:
+            args = tuple(shlex.split(git_cmd))
+        except ValueError:
+            return None
+        state = repo_state_key(path)
+        if state is None:
+            return None
+        return path, args, state
+
+    def get(self, key: tuple) -> GitResult | None:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires, result = entry
+        if time.monotonic() > expires:
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return result
+
+    def put(self, key: tuple, result: GitResult) -> None:
+        ttl = self.ttl
+        if key[1][0] in WORKTREE_COMMANDS:
+            ttl = min(ttl, self.worktree_ttl)
+        if ttl <= 0:
+            return
+        self.entries[key] = (time.monotonic() + ttl, result)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    async def key_for(self, path: Path, git_cmd: str) -> tuple | None:
+        """在 thread 裡算 make_key()；不能快取的指令不碰檔案系統"""
+        if self.ttl <= 0 or not is_read_only_command(git_cmd):
+            return None
+        return await asyncio.to_thread(self.make_key, path, git_cmd)
+
+    async def lookup(self, path: Path, git_cmd: str) -> GitResult | None:
+        """repo 沒變時直接回傳上次的結果"""
+        key = await self.key_for(path, git_cmd)
+        return self.get(key) if key else None
+
+    def invalidate(self, path: Path) -> None:
+        """清掉某個 repo 的所有快取"""
+        for key in [k for k in self.entries if k[0] == path]:
+            del self.entries[key]
+
+
+result_cache = ResultCache(
+    config.result_cache_size,
+    config.result_cache_ttl,
+    config.result_cache_worktree_ttl,
+)
+
+
+# ============================================================
+# 排程
+# ============================================================
+
+# 需要網路或比較重的指令，走慢速通道
+SLOW_COMMANDS = {"fetch", "pull", "push", "clone", "gc", "repack", "fsck", "prune"}
+
+
+def command_lane(git_cmd: str) -> str:
+    """決定指令要走快速還是慢速通道"""
+    args = git_cmd.split()
+    return "slow" if args and args[0] in SLOW_COMMANDS else "fast"
+
+
+@dataclass
+class GitJob:
+    """排隊中的 git 指令"""
+
+    user_id: int
+    path: Path
+    git_cmd: str
+    future: asyncio.Future
+    on_output: OutputCallback | None = None
+    # 不是一般的 git 指令（例如 /dash 的 status），worker 改成執行這個
+    run: Callable[[], Awaitable] | None = None
+
+
+class FairQueue:
+    """依使用者輪流出列的佇列（fair share）"""
+
+    def __init__(self) -> None:
+        self.queues: OrderedDict[int, deque[GitJob]] = OrderedDict()
+        self.ready = asyncio.Event()
+
+    def __len__(self) -> int:
+        return sum(len(q) for q in self.queues.values())
+
+    def put(self, job: GitJob) -> None:
+        self.queues.setdefault(job.user_id, deque()).append(job)
+        self.ready.set()
+
+    async def get(self) -> GitJob:
+        while not self.queues:
+            self.ready.clear()
+            await self.ready.wait()
+
+        # 取出排最前面的使用者的一個指令，再把該使用者移到隊尾
+        user_id, queue = next(iter(self.queues.items()))
+        job = queue.popleft()
+        if queue:
+            self.queues.move_to_end(user_id)
+        else:
+            del self.queues[user_id]
+        return job
+
+
+class InFlight:
+    """執行中的指令；相同指令的後來者共用同一個結果"""
+
+    def __init__(self) -> None:
+        self.task: asyncio.Task | None = None
+        self.listeners: list[OutputCallback] = []
+        self.waiters = 0
+
+    def broadcast(self, output: str, progress: str | None) -> None:
+        """把即時輸出轉給每個等待中的呼叫端"""
+        for listener in list(self.listeners):
+            listener(output, progress)
+
+    def finish(self, result: GitResult) -> None:
+        """結束時每個等待中的呼叫端各持有一份 document 參照"""
+        if result.document:
+            result.document.refs = self.waiters
+            if not self.waiters:
+                result.document.release()
+
+    async def join(self, on_output: OutputCallback | None) -> GitResult:
+        if on_output:
+            self.listeners.append(on_output)
+        self.waiters += 1
+        try:
+            # shield: 某個呼叫端被取消不會砍掉其他人也在等的指令
+            return await asyncio.shield(self.task)
+        except asyncio.CancelledError:
+            if not self.task.done():
+                self.waiters -= 1
+            elif not self.task.cancelled() and self.task.result().document:
+                self.task.result().document.release()
+            raise
+        finally:
+            if on_output:
+                self.listeners.remove(on_output)
+
+
+class RepoOrder:
+    """同一個 repo 的指令依送出順序生效
+
+    快慢通道各自排隊，快速通道的 log 可能超車還在排隊的 pull，快取也可能在
+    pull 之前就回答；所以送出的當下就登記：讀取要等前面的寫入做完，寫入要等
+    前面所有的指令做完。讀取之間不互相等待。
+    """
+
+    def __init__(self) -> None:
+        # repo -> (最後一個寫入, 那之後的讀取)；每個 future 在指令結束時完成
+        self.repos: dict[Path, tuple[asyncio.Future | None, list[asyncio.Future]]] = {}
+
+    def ticket(
+        self, path: Path, read_only: bool
+    ) -> tuple[list[asyncio.Future], asyncio.Future]:
+        """登記一個指令；回傳 (要先等的 future, 指令結束時要完成的 future)"""
+        last_write, reads = self.repos.get(path, (None, []))
+        done = asyncio.get_running_loop().create_future()
+        before = [last_write] if last_write else []
+        if read_only:
+            reads.append(done)
+            self.repos[path] = (last_write, reads)
+        else:
+            before += reads
+            self.repos[path] = (done, [])
+        done.add_done_callback(lambda _: self.cleanup(path))
+        return before, done
+
+    def cleanup(self, path: Path) -> None:
+        entry = self.repos.get(path)
+        if entry is None:
+            return
+        last_write, reads = entry
+        reads[:] = [f for f in reads if not f.done()]
+        if not reads and (last_write is None or last_write.done()):
+            del self.repos[path]
+
+
+repo_order = RepoOrder()
+
+
+class GitScheduler:
+    """限制同時執行的 git 指令數量，快慢指令各自有 worker"""
+
+    def __init__(self, workers: dict[str, int]) -> None:
+        self.workers = workers
+        self.lanes = {lane: FairQueue() for lane in workers}
+        self.tasks: list[asyncio.Task] = []
+        self.inflight: dict[tuple, InFlight] = {}
+
+    def pending(self) -> int:
+        """排隊中的指令數"""
+        return sum(len(q) for q in self.lanes.values())
+
+    def start(self) -> None:
+        """在目前的 event loop 啟動 workers"""
+        if self.tasks:
+            return
+        for lane, count in self.workers.items():
+            for _ in range(max(1, count)):
+                self.tasks.append(asyncio.create_task(self.worker(lane)))
+
+    async def submit(
+        self,
+        user_id: int,
+        path: Path,
+        git_cmd: str,
+        on_output: OutputCallback | None = None,
+    ) -> GitResult:
+        """依 repo 內的送出順序，先查快取，再併入相同的執行中指令，最後才排隊"""
+        before, done = repo_order.ticket(path, is_read_only_command(git_cmd))
+        # 順序已經登記，同一個 chat 的下一個指令可以開始
+        release_chat_order()
+        try:
+            if before:
+                await asyncio.wait(before)
+            return await self.dispatch(user_id, path, git_cmd, on_output)
+        finally:
+            if not done.done():
+                done.set_result(None)
+
+    async def dispatch(
+        self,
+        user_id: int,
+        path: Path,
+        git_cmd: str,
+        on_output: OutputCallback | None = None,
+    ) -> GitResult:
+        if cached := await result_cache.lookup(path, git_cmd):
+            return cached
+
+        try:
+            key = (path, tuple(shlex.split(git_cmd)))
+        except ValueError:
+            return await self.enqueue(user_id, path, git_cmd, on_output)
+
+        flight = self.inflight.get(key)
+        if flight is None:
+            flight = InFlight()
+            future = self.enqueue(user_id, path, git_cmd, flight.broadcast)
+            flight.task = asyncio.create_task(self.run_flight(key, flight, future))
+            self.inflight[key] = flight
+        return await flight.join(on_output)
+
+    async def run_flight(
+        self, key: tuple, flight: InFlight, future: asyncio.Future[GitResult]
+    ) -> GitResult:
+        try:
+            result = await future
+        finally:
+            del self.inflight[key]
+        flight.finish(result)
+        return result
+
+    def enqueue(
+        self,
+        user_id: int,
+        path: Path,
+        git_cmd: str,
+        on_output: OutputCallback | None = None,
+    ) -> asyncio.Future[GitResult]:
+        """排入指令（呼叫時就排好），回傳之後會有結果的 future"""
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        job = GitJob(user_id, path, git_cmd, future, on_output)
+        self.lanes[command_lane(git_cmd)].put(job)
+        return future
+
+    async def run_fast[T](
+        self, user_id: int, path: Path, run: Callable[[], Awaitable[T]]
+    ) -> T:
+        """在快速通道執行 run()，和一般指令共用 fast_workers 的上限與輪流順序"""
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        self.lanes["fast"].put(GitJob(user_id, path, "", future, run=run))
+        return await future
+
+    async def worker(self, lane: str) -> None:
+        queue = self.lanes[lane]
+        while True:
+            job = await queue.get()
+            if job.future.cancelled():
+                continue
+            if job.run:
+                try:
+                    result = await job.run()
+                except Exception as e:
+                    logger.exception("lane job failed")
+                    if not job.future.done():
+                        job.future.set_exception(e)
+                    continue
+                if not job.future.done():
+                    job.future.set_result(result)
+                continue
+            try:
+                result = await execute_git_command(
+                    job.path, job.git_cmd, job.on_output
+                )
+            except Exception as e:
+                logger.exception("git worker failed")
+                result = GitResult(
+                    success=False,
+                    output="",
+                    return_code=-1,
+                    error=str(e),
+                )
+            if not job.future.done():
+                job.future.set_result(result)
+
+
+scheduler = GitScheduler({"fast": config.fast_workers, "slow": config.slow_workers})
+
+
+# ============================================================
+# 多 repo 總覽（/dash）
+# ============================================================
+
+
+@dataclass
+class RepoSummary:
+    branch: str = ""
+    changes: int = 0
+    ahead: int | None = None  # 沒有 upstream 時為 None
+    behind: int | None = None
+    error: str | None = None
+
+
+def parse_status_v2(output: str) -> RepoSummary:
+    """解析 git status --porcelain=v2 --branch"""
+    summary = RepoSummary()
+    for line in output.splitlines():
+        if line.startswith("# branch.head "):
+            summary.branch = line[len("# branch.head ") :]
+        elif line.startswith("# branch.ab "):
+            ahead, behind = line[len("# branch.ab ") :].split()
+            summary.ahead, summary.behind = int(ahead), -int(behind)
+        elif line and not line.startswith("#"):
+            summary.changes += 1
+    return summary
+
+
+class DashCache:
+    """每個 repo 的總覽，repo 狀態（HEAD / index / refs）沒變且還沒過期就沿用"""
+
+    def __init__(self, ttl: float) -> None:
+        self.ttl = ttl
+        self.entries: dict[Path, tuple[tuple, float, RepoSummary]] = {}
+
+    def get(self, path: Path, state: tuple | None) -> RepoSummary | None:
+        entry = self.entries.get(path)
+        if entry is None or state is None or entry[0] != state:
+            return None
+        if time.monotonic() > entry[1]:
+            return None
+        return entry[2]
+
+    def put(self, path: Path, state: tuple | None, summary: RepoSummary) -> None:
+        if state is not None and summary.error is None:
+            self.entries[path] = (state, time.monotonic() + self.ttl, summary)
+
+
+# 工作目錄的修改不會改變 repo 狀態，所以跟 status 用一樣短的 TTL
+dash_cache = DashCache(config.result_cache_worktree_ttl)
+
+
+async def repo_summary(user_id: int, path: Path) -> RepoSummary:
+    """一個 repo 的 branch、未提交變更數與 ahead / behind"""
+    state = await asyncio.to_thread(repo_state_key, path)
+    cached = dash_cache.get(path, state)
+    if cached:
+        return cached
+    # 走 scheduler 的快速通道：好幾個 /dash 同時跑也不會超過 fast_workers 個 git
+    summary = await scheduler.run_fast(user_id, path, lambda: git_status_summary(path))
+    dash_cache.put(path, state, summary)
+    return summary
+
+
+async def git_status_summary(path: Path) -> RepoSummary:
+    """執行 git status --porcelain=v2 --branch 並解析"""
+    async with repo_locks.acquire(path, read_only=True):
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                GIT_BIN,
+                "status",
+                "--porcelain=v2",
+                "--branch",
+                cwd=str(path),
+                stdin=asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                env=GIT_READ_ONLY_ENV,
+                start_new_session=True,
+            )
+        except OSError as e:
+            return RepoSummary(error=str(e))
+        try:
+            stdout, stderr = await asyncio.wait_for(
+                proc.communicate(), timeout=config.command_timeout
+            )
+        except asyncio.TimeoutError:
+            kill_process_group(proc)
+            await proc.wait()
+            return RepoSummary(error="超時")
+
+    if proc.returncode != 0:
+        return RepoSummary(error=decode_head(stderr, 200).strip())
+    return parse_status_v2(stdout.decode("utf-8", errors="replace"))
+
+
+async def dash_summaries(user_id: int, repos: list[Path]) -> list[RepoSummary]:
+    """每個 repo 的摘要；快取沒有的排進快速通道"""
+    return await asyncio.gather(*(repo_summary(user_id, r) for r in repos))
+
+
+def format_dash(repos: list[Path], summaries: list[RepoSummary]) -> list[str]:
+    """每個 repo 一行：狀態、名稱、branch、ahead / behind、變更數"""
+    names = [prune.relative(str(r)) or r.name for r in repos]
+    name_width = min(max(len(n) for n in names), 28)
+    branch_width = min(max(len(s.branch) for s in summaries), 16)
+    lines = []
+    for name, s in zip(names, summaries):
+        if s.error:
+            lines.append(f"⚠️ {name:<{name_width}} {s.error.splitlines()[0][:40]}")
+            continue
+        icon = "✏️" if s.changes else "✅"
+        if s.ahead is None:
+            sync = "—"
+        elif s.ahead or s.behind:
+            sync = f"↑{s.ahead} ↓{s.behind}"
+        else:
+            sync = "="
+        changes = f" ±{s.changes}" if s.changes else ""
+        lines.append(
+            f"{icon} {name:<{name_width}} {s.branch:<{branch_width}} {sync}{changes}"
+        )
+    return lines
+
+
+# ============================================================
+# 即時輸出
+# ============================================================
+
+
+class MessageStreamer:
+    """把 git 的即時輸出節流、合併後更新到「處理中」訊息"""
+
+    def __init__(self, message: Message, header: str, interval: float) -> None:
+        self.message = message
+        self.header = header
+        self.interval = interval
+        self.latest: str | None = None
+        self.sent: str | None = None
+        self.next_edit = 0.0
+        self.task: asyncio.Task | None = None
+        self.closed = False
+
+    def update(self, output: str, progress: str | None) -> None:
+        """記下最新輸出；實際編輯訊息由背景 task 依間隔進行"""
+        text = self.header
+        if progress:
+            text += f"\n⏳ {progress}"
+        if output:
+            text += f"\n\n```\n{output}\n```"
+        self.latest = text
+        if self.task is None and not self.closed:
+            self.task = asyncio.create_task(self.flush())
+
+    async def flush(self) -> None:
+        loop = asyncio.get_running_loop()
+        try:
+            await asyncio.sleep(max(0.0, self.next_edit - loop.time()))
+            text = self.latest
+            if self.closed or text == self.sent:
+                return
+            try:
+                await self.message.edit_text(text, parse_mode="Markdown")
+                self.sent = text
+                self.next_edit = loop.time() + self.interval
+            except RetryAfter as e:
+                self.next_edit = loop.time() + float(e.retry_after)
+            except TelegramError as e:
+                logger.debug(f"stream edit failed: {e}")
+                self.next_edit = loop.time() + self.interval
+        finally:
+            self.task = None
+        if not self.closed and self.latest != self.sent:
+            self.task = asyncio.create_task(self.flush())
+
+    async def close(self) -> None:
+        """停止更新（之後由呼叫端送出最終結果）"""
+        self.closed = True
+        if self.task:
+            self.task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self.task
+
+
+def gzip_file(path: Path) -> Path:
+    """以串流方式壓縮檔案，回傳 .gz 路徑"""
+    gz_path = path.with_name(path.name + ".gz")
+    with open(path, "rb") as src, gzip.open(gz_path, "wb") as dst:
+        shutil.copyfileobj(src, dst)
+    return gz_path
+
+
+def format_git_result(
+    result: GitResult, project_name: str, git_cmd: str, machine: str | None = None
+) -> str:
+    """把執行結果排成回覆訊息"""
+    machine = machine or config.machine_name
+    if result.error:
+        return f"❌ **{machine}** / `{project_name}`\n\n錯誤: {result.error}"
+
+    cut_note = "\n\n⏹️ 輸出已達上限，git 已提前終止" if result.cut_early else ""
+    if result.success:
+        return (
+            f"✅ **{machine}** / `{project_name}`\n"
+            f"📍 `git {git_cmd}`\n\n"
+            f"```\n{result.output}\n```{cut_note}"
+        )
+    return (
+        f"⚠️ **{machine}** / `{project_name}`\n"
+        f"📍 `git {git_cmd}` (exit: {result.return_code})\n\n"
+        f"```\n{result.output}\n```"
+    )
+
+
+async def send_output_document(
+    message: Message, document: SpoolFile, filename: str, cut_early: bool = False
+) -> None:
+    """把輸出當成檔案上傳（超過門檻先 gzip）；cut_early 表示 git 被提前終止"""
+    path = document.path
+    if document.size > config.document_gzip_bytes:
+        path = await asyncio.to_thread(gzip_file, document.path)
+        filename += ".gz"
+
+    if cut_early:
+        # 只有 git 被砍掉之前的部分，不能標成完整輸出
+        caption = f"📎 部分輸出 ({document.size:,} bytes)，輸出已達上限，git 已提前終止"
+    else:
+        caption = f"📎 完整輸出 ({document.size:,} bytes)"
+    if document.truncated:
+        caption += f"，超過 {config.max_document_bytes:,} bytes 的部分已截斷"
+
+    try:
+        with open(path, "rb") as f:
+            # read_file_handle=False: 直接從檔案串流上傳，不整個讀進記憶體
+            await message.reply_document(
+                InputFile(f, filename=filename, read_file_handle=False),
+                caption=caption,
+                write_timeout=120,
+            )
+    finally:
+        if path != document.path:
+            path.unlink(missing_ok=True)
+
+
+# ============================================================
+# /list 分頁
+# ============================================================
+
+
+@dataclass
+class Listing:
+    query: str
+    repos: list[Path]
+    expires: float
+
+
+class ListingCache:
+    """/list 的結果快照，翻頁時直接從這裡取，不重新掃描"""
+
+    def __init__(self, ttl: float, max_entries: int = 64) -> None:
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries: OrderedDict[str, Listing] = OrderedDict()
+
+    def put(self, query: str, repos: list[Path]) -> str:
+        now = time.monotonic()
+        while self.entries and (
+            len(self.entries) >= self.max_entries
+            or next(iter(self.entries.values())).expires <= now
+        ):
+            self.entries.popitem(last=False)
+        key = secrets.token_urlsafe(6)
+        self.entries[key] = Listing(query, repos, now + self.ttl)
+        return key
+
+    def get(self, key: str) -> Listing | None:
+        listing = self.entries.get(key)
+        if listing is None or listing.expires <= time.monotonic():
+            return None
+        return listing
+
+
+listings = ListingCache(config.list_cache_ttl)
+
+
+def render_list_page(
+    key: str, listing: Listing, page: int
+) -> tuple[str, InlineKeyboardMarkup | None]:
+    """第 page 頁（從 0 開始）的文字與翻頁按鈕"""
+    pages = max(1, -(-len(listing.repos) // LIST_PAGE_SIZE))
+    page = min(max(page, 0), pages - 1)
+    start = page * LIST_PAGE_SIZE
+    repos_text = "\n".join(
+        f"  • `{r}`" for r in listing.repos[start : start + LIST_PAGE_SIZE]
+    )
+    query = f"（`{listing.query}`）" if listing.query else ""
+    text = f"📁 **找到 {len(listing.repos)} 個 Git Repo{query}:**\n\n{repos_text}"
+    if pages == 1:
+        return text, None
+
+    text += f"\n\n📄 第 {page + 1}/{pages} 頁"
+    buttons = []
+    if page > 0:
+        buttons.append(
+            InlineKeyboardButton("⬅️ 上一頁", callback_data=f"list:{key}:{page - 1}")
+        )
+    if page < pages - 1:
+        buttons.append(
+            InlineKeyboardButton("下一頁 ➡️", callback_data=f"list:{key}:{page + 1}")
+        )
+    return text, InlineKeyboardMarkup([buttons])
+
+
+# ============================================================
+# /git 請求
+# ============================================================
+
+
+def rejected(message: str) -> GitResult:
+    return GitResult(
+        success=False, output="", return_code=-1, error=message, rejected=True
+    )
+
+
+async def run_git_request(
+    user_id: int,
+    path_str: str,
+    git_cmd: str,
+    on_output: OutputCallback | None = None,
+) -> tuple[str, GitResult]:
+    """驗證並執行一個 /git 請求，回傳 (專案名稱, 結果)
+
+    本機的 /git 與 gateway 轉來的請求都走這裡；驗證沒過時 result.rejected 為 True。
+    """
+    # 驗證指令
+    is_valid, first_word = is_valid_git_command(git_cmd)
+    if not is_valid:
+        return "", rejected(
+            f"❌ 不允許的指令: `{first_word or '(空)'}`\n\n"
+            f"允許: `{', '.join(config.allowed_git_commands)}`"
+        )
+
+    # 用名稱找 repo
+    if not is_path_like(path_str):
+        names = await known_repo_names()
+        matches = names.lookup(path_str)
+        if len(matches) > 1:
+            shown = "\n".join(f"  • `{m}`" for m in matches[:10])
+            more = f"\n  ... 還有 {len(matches) - 10} 個" if len(matches) > 10 else ""
+            return "", rejected(
+                f"🔀 `{path_str}` 符合多個 repo:\n{shown}{more}\n\n"
+                f"💡 打長一點的路徑結尾，例如 `{matches[0].parent.name}/{matches[0].name}`"
+            )
+        if matches:
+            path_str = str(matches[0])
+
+    # 解析並檢查路徑（檔案系統操作都在 thread pool）
+    target_path, problem = await validate_target(path_str)
+
+    if problem == "timeout":
+        return "", rejected(
+            f"⏳ 檢查路徑逾時: `{path_str}`\n\n💡 磁碟或網路掛載可能沒有回應"
+        )
+
+    if problem == "invalid":
+        return "", rejected(f"❌ 無效路徑: `{path_str}`")
 
-    @classmethod
-    def load(cls, path: Path) -> "Config":
-        """從 JSON 檔載入設定"""
-        with open(path) as f:
-            data = json.load(f)
+    if problem == "missing":
+        suggestions = (await known_repo_names()).suggest(path_str)
 
-        return cls(
-            machine_name=data["machine_name"],
-            allowed_paths=[
-                Path(p).expanduser().resolve() for p in data["allowed_paths"]
-            ],
-            allowed_user_ids=data["allowed_user_ids"],
-            allowed_git_commands=data["allowed_git_commands"],
-            command_timeout=data.get("command_timeout", 60),
-            max_output_length=data.get("max_output_length", 3500),
+        suggestion_text = ""
+        if suggestions:
+            suggestion_text = "\n\n**可能你要找:**\n" + "\n".join(
+                f"  • `{s}`" for s in suggestions
+            )
+        return "", rejected(f"❌ 資料夾不存在: `{target_path}`{suggestion_text}")
+
+    if problem == "not_dir":
+        return "", rejected(f"❌ 不是資料夾: `{target_path}`")
+
+    if problem == "not_allowed":
+        paths_list = "\n".join(f"  • `{p}`" for p in config.allowed_paths)
+        return "", rejected(
+            f"❌ 路徑不在允許範圍: `{target_path}`\n\n**允許:**\n{paths_list}"
         )
 
+    if problem == "not_repo":
+        return "", rejected(f"❌ 不是 Git Repo: `{target_path}`\n\n💡 沒有 `.git` 目錄")
 
-config = Config.load(CONFIG_FILE)
+    # 執行
+    logger.info(f"User {user_id}: git {git_cmd} in {target_path}")
+    start = time.monotonic()
+    result = await scheduler.submit(user_id, target_path, git_cmd, on_output)
+    global last_command_latency
+    last_command_latency = time.monotonic() - start
+    return target_path.name, result
 
 
 # ============================================================
-# 安全檢查
+# 機器健康狀態（心跳）
 # ============================================================
 
-
-def is_user_allowed(user_id: int) -> bool:
-    """檢查使用者是否有權限"""
-    if not config.allowed_user_ids:
-        return True
-    return user_id in config.allowed_user_ids
+# 上一個 /git 從排隊到完成花的秒數
+last_command_latency: float | None = None
 
 
-def is_path_allowed(target_path: Path) -> bool:
-    """檢查路徑是否在允許範圍內（但不能是 ~ 本身）"""
+def system_health() -> tuple[float | None, int | None]:
+    """(load average, 允許路徑中最少的可用空間)；會碰磁碟，在 thread 裡呼叫"""
     try:
-        resolved = target_path.expanduser().resolve()
-        home = Path.home().resolve()
-
-        # 不允許直接操作 home 目錄本身
-        if resolved == home:
-            return False
-
-        # 允許 home 底下的任何子資料夾
-        for allowed in config.allowed_paths:
-            if resolved == allowed or allowed in resolved.parents:
-                return True
-        return False
-    except Exception:
-        return False
+        load = os.getloadavg()[0]
+    except OSError:
+        load = None
+    free = []
+    for path in config.allowed_paths:
+        with suppress(OSError):
+            free.append(shutil.disk_usage(path).free)
+    return load, min(free, default=None)
+
+
+async def machine_health() -> dict:
+    """這台機器目前的負載；agent 定期當作心跳送給 gateway
+
+    佇列長度在 event loop 上讀，scheduler 的佇列只在 loop 上修改。
+    """
+    load, disk_free = await asyncio.to_thread(system_health)
+    return {
+        "load": load,
+        "queue": scheduler.pending(),
+        "latency": last_command_latency,
+        "disk_free": disk_free,
+    }
+
+
+def format_health(
+    machine: str, health: dict | None, age: float | None = None, online: bool = True
+) -> str:
+    """/status 裡一台機器的一行；age 是距離上次心跳的秒數（本機為 None）"""
+    if health is None:
+        return f"🔴 **{machine}** — 沒有心跳"
+    interval = health.get("interval", config.heartbeat_interval)
+    stale = not online or (age is not None and age > 3 * interval)
+    parts = []
+    if health["load"] is not None:
+        parts.append(f"load {health['load']:.2f}")
+    parts.append(f"佇列 {health['queue']}")
+    if health["latency"] is not None:
+        parts.append(f"上次 {health['latency'] * 1000:.0f} ms")
+    if health["disk_free"] is not None:
+        parts.append(f"可用 {health['disk_free'] / 1e9:.1f} GB")
+    line = f"{'🔴' if stale else '🟢'} **{machine}** — " + " · ".join(parts)
+    if age is not None:
+        line += f"（{age:.0f} 秒前{'，已離線' if not online else ''}）"
+    return line
 
 
-def is_valid_git_command(cmd: str) -> tuple[bool, str]:
-    """檢查是否為允許的 git 指令"""
-    cmd = cmd.strip()
-    if not cmd:
-        return False, ""
-    first_word = cmd.split()[0]
-    return first_word in config.allowed_git_commands, first_word
+# ============================================================
+# Gateway / Agent（一個 bot 連線，轉送給各台機器）
+# ============================================================
 
+# 單行 JSON 的上限（輸出已經被 max_output_length 截短，這只是保險）
+RPC_LINE_LIMIT = 4 * 1024 * 1024
+RPC_HANDSHAKE_TIMEOUT = 10
+# 轉送的指令在 command_timeout 之外，再給 agent 排隊與回傳結果的時間
+RPC_CALL_MARGIN = 30
 
-def is_git_repo(path: Path) -> bool:
-    """檢查是否為 git repository"""
-    git_dir = path / ".git"
-    return git_dir.exists() and git_dir.is_dir()
 
+def rpc_mac(nonce: str, label: str) -> str:
+    """用 rpc_secret 對 challenge 簽章；label 區分 gateway 與 agent，不能互相重放"""
+    message = f"{label}:{nonce}".encode()
+    return hmac.new(config.rpc_secret.encode(), message, hashlib.sha256).hexdigest()
 
-def sanitize_input(text: str) -> str:
-    """移除危險字元"""
-    return re.sub(r"[;&|`$(){}\\]", "", text)
 
+async def rpc_connect(
+    address: str,
+) -> tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+    """連到 unix:/path 或 host:port"""
+    if address.startswith("unix:"):
+        return await asyncio.open_unix_connection(
+            address[len("unix:") :], limit=RPC_LINE_LIMIT
+        )
+    host, port = address.rsplit(":", 1)
+    return await asyncio.open_connection(host, int(port), limit=RPC_LINE_LIMIT)
+
+
+async def rpc_listen(address: str, handler) -> asyncio.Server:
+    """在 unix:/path（權限 600）或 host:port 上等待連線"""
+    if address.startswith("unix:"):
+        path = address[len("unix:") :]
+        with suppress(FileNotFoundError):
+            os.unlink(path)
+        server = await asyncio.start_unix_server(handler, path, limit=RPC_LINE_LIMIT)
+        os.chmod(path, 0o600)
+        return server
+    host, port = address.rsplit(":", 1)
+    return await asyncio.start_server(handler, host, int(port), limit=RPC_LINE_LIMIT)
+
+
+def send_frame(writer: asyncio.StreamWriter, frame: dict) -> None:
+    """一行一個 JSON（不等 drain，呼叫端需要時自己 drain）"""
+    writer.write(json.dumps(frame, ensure_ascii=False).encode() + b"\n")
+
+
+async def read_frame(reader: asyncio.StreamReader) -> dict | None:
+    """讀一個 frame；連線關閉時回傳 None"""
+    line = await reader.readline()
+    if not line:
+        return None
+    return json.loads(line)
+
+
+def result_to_frame(project: str, result: GitResult) -> dict:
+    return {
+        "project": project,
+        "success": result.success,
+        "output": result.output,
+        "return_code": result.return_code,
+        "error": result.error,
+        "cut_early": result.cut_early,
+        "rejected": result.rejected,
+    }
+
+
+def frame_to_result(frame: dict) -> tuple[str, GitResult]:
+    return frame["project"], GitResult(
+        success=frame["success"],
+        output=frame["output"],
+        return_code=frame["return_code"],
+        error=frame["error"],
+        cut_early=frame["cut_early"],
+        rejected=frame["rejected"],
+    )
 
-def find_git_repos(base_path: Path, max_depth: int = 3) -> list[Path]:
-    """遞迴尋找 git repositories"""
-    repos = []
 
-    def search(path: Path, depth: int):
-        if depth > max_depth:
+class AgentError(Exception):
+    """轉送給 agent 的請求沒有拿到結果；訊息可以直接回覆給使用者"""
+
+
+class AgentLink:
+    """gateway 這端與一台 agent 的連線"""
+
+    def __init__(
+        self, machine: str, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        self.machine = machine
+        self.reader = reader
+        self.writer = writer
+        self.ids = itertools.count(1)
+        self.health: dict | None = None  # 最近一次心跳的內容
+        self.last_seen = time.monotonic()
+        # request id -> (結果, 即時輸出 callback)
+        self.pending: dict[int, tuple[asyncio.Future, OutputCallback | None]] = {}
+
+    async def call(
+        self,
+        user_id: int,
+        path_str: str,
+        git_cmd: str,
+        on_output: OutputCallback | None = None,
+    ) -> tuple[str, GitResult]:
+        """轉送 /git；拿不到結果時回傳被拒絕的結果"""
+        frame = {
+            "type": "git",
+            "user_id": user_id,
+            "path": path_str,
+            "command": git_cmd,
+        }
+        try:
+            return frame_to_result(await self.request(frame, on_output))
+        except AgentError as e:
+            return "", rejected(str(e))
+
+    async def request(
+        self, frame: dict, on_output: OutputCallback | None = None
+    ) -> dict:
+        """送出請求並等待 agent 回傳的 result frame；失敗時丟出 AgentError"""
+        request_id = next(self.ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = (future, on_output)
+        deadline = config.command_timeout + RPC_CALL_MARGIN
+        try:
+            # 卡住的 agent（暫停、休眠、半斷的 TCP）不能讓請求永遠等下去
+            async with asyncio.timeout(deadline):
+                send_frame(self.writer, {**frame, "id": request_id})
+                # frame 已經依序寫進連線，agent 會照這個順序收到
+                release_chat_order()
+                await self.writer.drain()
+                return await future
+        except ConnectionError as e:
+            raise AgentError(
+                f"❌ `{self.machine}` 連線中斷，指令結果不明: {e}"
+            ) from e
+        except TimeoutError:
+            raise AgentError(
+                f"⏳ `{self.machine}` 超過 {deadline:.0f} 秒沒有回傳結果，指令結果不明"
+            ) from None
+        finally:
+            self.pending.pop(request_id, None)
+
+    @property
+    def age(self) -> float:
+        """距離上次心跳（或連線）的秒數"""
+        return time.monotonic() - self.last_seen
+
+    @property
+    def interval(self) -> float:
+        """agent 回報的心跳間隔（還沒收到心跳時用自己的設定）"""
+        return (self.health or {}).get("interval", config.heartbeat_interval)
+
+    @property
+    def healthy(self) -> bool:
+        """連續漏掉三次心跳就當作沒有回應（連線可能已經半斷）"""
+        return self.age < 3 * self.interval
+
+    def fail_pending(self, message: str) -> None:
+        """讓所有等待中的請求以 AgentError(message) 結束"""
+        for future, _ in self.pending.values():
+            if not future.done():
+                future.set_exception(AgentError(message))
+
+    async def watchdog(self) -> None:
+        """心跳停了就不再等執行中的指令（agent 被暫停、休眠或連線半斷）"""
+        while True:
+            await asyncio.sleep(self.interval)
+            if not self.healthy and self.pending:
+                self.fail_pending(
+                    f"💤 `{self.machine}` 已 {self.age:.0f} 秒沒有心跳，指令結果不明"
+                )
+
+    async def serve(self) -> None:
+        """讀 agent 傳回來的輸出與結果，直到連線中斷"""
+        watchdog = asyncio.create_task(self.watchdog())
+        try:
+            while frame := await read_frame(self.reader):
+                if frame.get("type") == "heartbeat":
+                    self.health = frame["health"]
+                    self.last_seen = time.monotonic()
+                    continue
+                future, on_output = self.pending.get(frame.get("id"), (None, None))
+                if future is None:
+                    continue
+                if frame["type"] == "output" and on_output:
+                    on_output(frame["output"], frame.get("progress"))
+                elif frame["type"] == "result" and not future.done():
+                    future.set_result(frame)
+        except (ConnectionError, ValueError) as e:
+            logger.warning(f"agent {self.machine} 連線錯誤: {e}")
+        finally:
+            watchdog.cancel()
+            self.fail_pending(f"❌ `{self.machine}` 連線中斷，指令結果不明")
+            self.writer.close()
+
+
+class Gateway:
+    """接受 agent 連線（HMAC challenge 驗證），把 /git 轉給對應的機器"""
+
+    def __init__(self) -> None:
+        self.agents: dict[str, AgentLink] = {}  # 小寫機器名稱 -> 連線
+        # 連線過的每一台 agent 最後的連線（含最後一次心跳），斷線後也留著給 /status
+        self.registry: dict[str, AgentLink] = {}
+        self.server: asyncio.Server | None = None
+
+    async def start(self) -> None:
+        self.server = await rpc_listen(config.rpc_address, self.accept)
+        logger.info(f"🛰️ Gateway 等待 agent 連線: {config.rpc_address}")
+
+    async def accept(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            nonce = secrets.token_hex(16)
+            send_frame(writer, {"type": "challenge", "nonce": nonce})
+            await writer.drain()
+            hello = await asyncio.wait_for(read_frame(reader), RPC_HANDSHAKE_TIMEOUT)
+            machine = str(hello["machine"])
+            expected = rpc_mac(nonce, f"agent:{machine}")
+            if not hmac.compare_digest(str(hello["mac"]), expected):
+                raise ValueError("簽章不符")
+            send_frame(
+                writer,
+                {"type": "welcome", "mac": rpc_mac(str(hello["nonce"]), "gateway")},
+            )
+            await writer.drain()
+        except (OSError, ValueError, KeyError, TypeError, asyncio.TimeoutError) as e:
+            logger.warning(f"拒絕 agent 連線: {e!r}")
+            writer.close()
             return
+
+        link = AgentLink(machine, reader, writer)
+        old = self.agents.get(machine.lower())
+        self.agents[machine.lower()] = link
+        self.registry[machine.lower()] = link
+        if old:
+            old.writer.close()
+        logger.info(f"🛰️ agent 已連線: {machine}")
         try:
-            if (path / ".git").is_dir():
-                repos.append(path)
-                return
-            for child in path.iterdir():
-                if child.is_dir() and not child.name.startswith("."):
-                    search(child, depth + 1)
-        except PermissionError:
-            pass
+            await link.serve()
+        finally:
+            if self.agents.get(machine.lower()) is link:
+                del self.agents[machine.lower()]
+            logger.info(f"🛰️ agent 已離線: {machine}")
+
+    async def forward(
+        self,
+        machine: str,
+        user_id: int,
+        path_str: str,
+        git_cmd: str,
+        on_output: OutputCallback | None = None,
+    ) -> tuple[str, str, GitResult]:
+        """回傳 (機器名稱, 專案名稱, 結果)"""
+        try:
+            link = self.link_for(machine)
+        except AgentError as e:
+            return machine, "", rejected(str(e))
+        project, result = await link.call(user_id, path_str, git_cmd, on_output)
+        return link.machine, project, result
+
+    async def dash(self, machine: str, user_id: int) -> list[str]:
+        """請 agent 產生 /dash 的訊息"""
+        try:
+            reply = await self.link_for(machine).request(
+                {"type": "dash", "user_id": user_id}
+            )
+        except AgentError as e:
+            return [str(e)]
+        return reply["messages"]
+
+    def link_for(self, machine: str) -> AgentLink:
+        """連線中且有心跳的 agent；否則丟出 AgentError"""
+        link = self.agents.get(machine.lower())
+        if link is None:
+            raise AgentError(f"❌ `{machine}` 沒有連線到 gateway")
+        if not link.healthy:
+            raise AgentError(
+                f"💤 `{link.machine}` 已 {link.age:.0f} 秒沒有心跳，略過"
+            )
+        return link
+
+
+gateway = Gateway()
+
+
+async def run_on(
+    machine: str,
+    user_id: int,
+    path_str: str,
+    git_cmd: str,
+    on_output: OutputCallback | None = None,
+) -> tuple[str, str, GitResult]:
+    """在本機或轉給 agent 執行，回傳 (機器名稱, 專案名稱, 結果)
 
-    search(base_path, 0)
-    return sorted(repos)
+    意外的例外也轉成被拒絕的結果，呼叫端一定能把「處理中」訊息改掉。
+    """
+    try:
+        if machine.lower() == config.machine_name.lower():
+            project, result = await run_git_request(
+                user_id, path_str, git_cmd, on_output
+            )
+            return config.machine_name, project, result
+        return await gateway.forward(machine, user_id, path_str, git_cmd, on_output)
+    except Exception as e:
+        logger.exception(f"git on {machine} failed")
+        return machine, "", rejected(f"❌ `{machine}` 執行失敗: {e}")
 
 
 # ============================================================
-# Git 執行
+# 多台機器同時執行（/git all、機器群組）
 # ============================================================
 
+# Telegram 單則訊息上限 4096 字，留一點給 Markdown
+MESSAGE_LIMIT = 4000
+
+
+def fanout_targets(name: str) -> list[str] | None:
+    """all 或 machine_groups 的群組名稱 -> 機器清單；都不是時回傳 None"""
+    if name.lower() == "all":
+        machines = [config.machine_name]
+        if config.mode == "gateway":
+            machines += sorted(link.machine for link in gateway.agents.values())
+        return machines
+    for group, members in config.machine_groups.items():
+        if group.lower() == name.lower():
+            return members
+    return None
+
+
+def format_fanout_section(
+    machine: str, project: str, result: GitResult | None, chars: int
+) -> str:
+    """合併回覆中一台機器的段落；result 為 None 表示超過期限"""
+    if result is None:
+        return f"⏳ **{machine}** — {config.fanout_deadline:g} 秒內沒有回應"
+    if result.rejected or result.error:
+        return f"❌ **{machine}** — {result.error.removeprefix('❌ ')}"
+    output = result.output
+    if len(output) > chars:
+        output = output[:chars].rstrip() + "\n..."
+    if result.success:
+        title = f"✅ **{machine}** / `{project}`"
+    else:
+        title = f"⚠️ **{machine}** / `{project}` (exit: {result.return_code})"
+    return f"{title}\n```\n{output}\n```"
 
-@dataclass
-class GitResult:
-    """Git 指令執行結果"""
-
-    success: bool
-    output: str
-    return_code: int
-    error: str | None = None
 
+async def fanout_command(
+    update: Update, name: str, targets: list[str], path_str: str, git_cmd: str
+) -> None:
+    """同時在多台機器執行，期限內沒回來的標成逾時，合併成一則回覆"""
+    if not targets:
+        await update.message.reply_text(
+            f"❌ 群組 `{name}` 沒有任何機器", parse_mode="Markdown"
+        )
+        return
 
-def execute_git_command(path: Path, git_cmd: str) -> GitResult:
-    """在指定路徑執行 git 指令"""
-    full_command = f"git {git_cmd}"
+    path_str = sanitize_input(path_str)
+    git_cmd = sanitize_input(git_cmd)
+    processing_msg = await update.message.reply_text(
+        f"🔄 `{name}`（{len(targets)} 台）處理中...", parse_mode="Markdown"
+    )
 
+    user_id = update.effective_user.id
+    tasks = {
+        machine: asyncio.create_task(run_on(machine, user_id, path_str, git_cmd))
+        for machine in targets
+    }
+    done, pending = await asyncio.wait(tasks.values(), timeout=config.fanout_deadline)
+    for task in pending:
+        task.cancel()
+
+    chars = max(200, config.max_output_length // max(1, len(targets)))
+    sections = []
+    for machine, task in tasks.items():
+        if task in done and (error := task.exception()):
+            # run_on 已經接住一般例外，這裡是保險
+            logger.error(f"fan-out to {machine} failed: {error!r}")
+            result = rejected(f"❌ `{machine}` 執行失敗: {error}")
+            sections.append(format_fanout_section(machine, "", result, chars))
+        elif task in done:
+            label, project, result = task.result()
+            if result.document:
+                result.document.release()
+            sections.append(format_fanout_section(label, project, result, chars))
+        else:
+            sections.append(format_fanout_section(machine, "", None, chars))
+
+    header = f"📡 **{name}** — {len(done)}/{len(targets)} 台回應\n📍 `git {git_cmd}`"
+    # 太長就分成多則訊息，段落不切開
+    messages = [header]
+    for section in sections:
+        if len(messages[-1]) + len(section) + 2 > MESSAGE_LIMIT:
+            messages.append(section)
+        else:
+            messages[-1] += "\n\n" + section
+    await processing_msg.edit_text(messages[0], parse_mode="Markdown")
+    for text in messages[1:]:
+        await update.message.reply_text(text, parse_mode="Markdown")
+
+
+async def run_agent() -> None:
+    """agent 模式：連到 gateway 執行轉過來的 /git，斷線就重連"""
+    # 保留 task 的參照，避免被回收
+    background = {asyncio.create_task(refresh_repo_index())}
+    if config.watch_repos:
+        await repo_watcher.start()
+    else:
+        background.add(asyncio.create_task(rescan_periodically()))
+    delay = 1
+    while True:
+        try:
+            reader, writer = await rpc_connect(config.rpc_address)
+            await agent_handshake(reader, writer)
+            logger.info(f"🛰️ 已連上 gateway: {config.rpc_address}")
+            delay = 1
+            await agent_serve(reader, writer)
+            logger.warning("🛰️ 與 gateway 的連線中斷")
+        except (OSError, ValueError, KeyError, asyncio.TimeoutError) as e:
+            logger.warning(f"🛰️ 無法連上 gateway ({e!r})，{delay} 秒後重試")
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 30)
+
+
+async def agent_handshake(
+    reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+) -> None:
+    """回應 gateway 的 challenge，並驗證 gateway 也知道同一個 secret"""
+    challenge = await asyncio.wait_for(read_frame(reader), RPC_HANDSHAKE_TIMEOUT)
+    if not isinstance(challenge, dict) or not isinstance(challenge.get("nonce"), str):
+        # 例如 gateway 重新啟動中，接受連線後馬上關閉
+        writer.close()
+        raise ValueError("gateway 沒有送出 challenge")
+    nonce = secrets.token_hex(16)
+    send_frame(
+        writer,
+        {
+            "type": "hello",
+            "machine": config.machine_name,
+            "nonce": nonce,
+            "mac": rpc_mac(challenge["nonce"], f"agent:{config.machine_name}"),
+        },
+    )
+    await writer.drain()
+    welcome = await asyncio.wait_for(read_frame(reader), RPC_HANDSHAKE_TIMEOUT)
+    if welcome is None:
+        writer.close()
+        raise ValueError("gateway 拒絕連線（rpc_secret 不一致？）")
+    if not hmac.compare_digest(str(welcome.get("mac")), rpc_mac(nonce, "gateway")):
+        writer.close()
+        raise ValueError("gateway 驗證失敗")
+
+
+def release_once(lock: asyncio.Lock) -> Callable[[], None]:
+    """回傳只會放開 lock 一次的 callback"""
+    released = False
+
+    def release() -> None:
+        nonlocal released
+        if not released:
+            released = True
+            lock.release()
+
+    return release
+
+
+async def agent_serve(
+    reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+) -> None:
+    tasks: set[asyncio.Task] = set()
+    heartbeat = asyncio.create_task(agent_heartbeat(writer))
+    # 前一個請求排進 scheduler 之前不開始下一個，順序和 gateway 送出的一致
+    order = asyncio.Lock()
     try:
-        result = subprocess.run(
-            full_command,
-            shell=True,
-            cwd=str(path),
-            capture_output=True,
-            text=True,
-            timeout=config.command_timeout,
-            env={**os.environ, "GIT_TERMINAL_PROMPT": "0"},
-        )
+        while frame := await read_frame(reader):
+            if frame.get("type") == "git":
+                await order.acquire()
+                context = copy_context()
+                context.run(chat_order_release.set, release_once(order))
+                task = asyncio.create_task(agent_handle(writer, frame), context=context)
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            elif frame.get("type") == "dash":
+                task = asyncio.create_task(agent_dash(writer, frame))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+    except (ConnectionError, ValueError):
+        pass
+    finally:
+        heartbeat.cancel()
+        writer.close()
+
+
+async def agent_heartbeat(writer: asyncio.StreamWriter) -> None:
+    """每 heartbeat_interval 秒把 machine_health() 送給 gateway"""
+    while not writer.is_closing():
+        try:
+            health = await machine_health()
+            health["interval"] = config.heartbeat_interval
+            send_frame(writer, {"type": "heartbeat", "health": health})
+            await writer.drain()
+        except ConnectionError:
+            pass
+        except Exception:
+            # 一次失敗不能讓心跳停掉，否則 gateway 會一直當這台沒有回應
+            logger.exception("heartbeat failed")
+        await asyncio.sleep(config.heartbeat_interval)
 
-        output = result.stdout.strip() or result.stderr.strip() or "(無輸出)"
 
-        if len(output) > config.max_output_length:
-            output = output[: config.max_output_length] + "\n... (已截斷)"
+async def agent_handle(writer: asyncio.StreamWriter, frame: dict) -> None:
+    """執行一個轉過來的 /git；即時輸出依 stream_edit_interval 的一半節流後回傳"""
+    request_id = frame["id"]
+    last_sent = 0.0
 
-        return GitResult(
-            success=result.returncode == 0,
-            output=output,
-            return_code=result.returncode,
+    def on_output(output: str, progress: str | None) -> None:
+        nonlocal last_sent
+        now = time.monotonic()
+        if now - last_sent < config.stream_edit_interval / 2 or writer.is_closing():
+            return
+        last_sent = now
+        send_frame(
+            writer,
+            {
+                "type": "output",
+                "id": request_id,
+                "output": output,
+                "progress": progress,
+            },
         )
 
-    except subprocess.TimeoutExpired:
-        return GitResult(
-            success=False,
-            output="",
-            return_code=-1,
-            error=f"超時 ({config.command_timeout}秒)",
-        )
-    except Exception as e:
-        return GitResult(
-            success=False,
-            output="",
-            return_code=-1,
-            error=str(e),
-        )
+    try:
+        if not is_user_allowed(frame["user_id"]):
+            project, result = "", rejected(f"❌ 沒有權限 (ID: `{frame['user_id']}`)")
+        else:
+            project, result = await run_git_request(
+                frame["user_id"], frame["path"], frame["command"], on_output
+            )
+    finally:
+        # 驗證沒過、沒有排進 scheduler 時也要讓下一個請求開始
+        release_chat_order()
+    # 完整輸出的檔案不轉送，留在 agent 本機就刪掉
+    if result.document:
+        result.document.release()
+    if writer.is_closing():
+        return
+    frame = {"type": "result", "id": request_id, **result_to_frame(project, result)}
+    send_frame(writer, frame)
+    with suppress(ConnectionError):
+        await writer.drain()
+
+
+async def agent_dash(writer: asyncio.StreamWriter, frame: dict) -> None:
+    """產生轉過來的 /dash 的訊息，傳回 gateway"""
+    if not is_user_allowed(frame["user_id"]):
+        messages = [f"❌ 沒有權限 (ID: `{frame['user_id']}`)"]
+    else:
+        try:
+            messages = await dash_report(frame["user_id"])
+        except Exception as e:
+            logger.exception("dash failed")
+            messages = [f"❌ `{config.machine_name}` 統計失敗: {e}"]
+    if writer.is_closing():
+        return
+    send_frame(writer, {"type": "result", "id": frame["id"], "messages": messages})
+    with suppress(ConnectionError):
+        await writer.drain()
 
 
 # ============================================================
@@ -246,13 +2961,18 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         f"`{commands}`\n\n"
         f"**其他指令:**\n"
         f"• /status - Bot 狀態\n"
-        f"• /list - 列出專案\n\n"
+        f"• /list [關鍵字] - 列出專案（可用路徑過濾）\n"
+        f"• /dash <machine> - 所有專案的 branch 與變更總覽\n\n"
         f"**範例:**\n"
         f"```\n"
         f"/git {config.machine_name} ~/projects/app status\n"
         f"/git {config.machine_name} ~/projects/app pull\n"
         f"/git {config.machine_name} ~/projects/app log -5 --oneline\n"
-        f"```",
+        f"/git {config.machine_name} app status\n"
+        f"/git all app status\n"
+        f"```\n"
+        f"<path> 不是 ~、/、. 開頭時，會用 repo 名稱或路徑結尾尋找\n"
+        f"<machine> 用 all 或 machine_groups 的群組名稱可一次在多台執行",
         parse_mode="Markdown",
     )
 
@@ -268,30 +2988,132 @@ async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         return
 
     paths_list = "\n".join(f"  • `{p}`" for p in config.allowed_paths)
+    machines = [format_health(config.machine_name, await machine_health())]
+    if config.mode == "gateway":
+        # 連線過的 agent（斷線的也列出來）加上群組裡從沒連上過的機器
+        names = {config.machine_name.lower()}
+        for key, link in sorted(gateway.registry.items()):
+            online = gateway.agents.get(key) is link
+            machines.append(format_health(link.machine, link.health, link.age, online))
+            names.add(key)
+        for members in config.machine_groups.values():
+            for member in members:
+                if member.lower() not in names:
+                    machines.append(format_health(member, None))
+                    names.add(member.lower())
 
     await update.message.reply_text(
         f"🤖 **Git Bot 狀態**\n\n"
         f"**機器:** `{config.machine_name}`\n"
         f"**狀態:** 🟢 運行中\n\n"
+        f"**機器狀態:**\n" + "\n".join(machines) + "\n\n"
         f"**允許路徑:**\n{paths_list}",
         parse_mode="Markdown",
     )
 
 
+async def dash_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """處理 /dash：所有 repo 的 branch、變更與同步狀態"""
+    if not is_user_allowed(update.effective_user.id):
+        return
+
+    args = context.args
+    if not args:
+        await update.message.reply_text(
+            f"📖 **使用方式:** `/dash <machine>`\n\n"
+            f"例如 `/dash {config.machine_name}`",
+            parse_mode="Markdown",
+        )
+        return
+    # 不是這台機器：gateway 轉給 agent，否則忽略
+    machine = args[0]
+    local = machine.lower() == config.machine_name.lower()
+    if not local and config.mode != "gateway":
+        return
+
+    msg = await update.message.reply_text(
+        f"📊 `{machine}` 統計中...", parse_mode="Markdown"
+    )
+    # 統計可能要好幾秒，不必讓同一個 chat 的下一個指令等它
+    release_chat_order()
+    user_id = update.effective_user.id
+    if local:
+        texts = await dash_report(user_id)
+    else:
+        texts = await gateway.dash(machine, user_id)
+    await msg.edit_text(texts[0], parse_mode="Markdown")
+    for text in texts[1:]:
+        await update.message.reply_text(text, parse_mode="Markdown")
+
+
+async def dash_report(user_id: int) -> list[str]:
+    """這台機器的 /dash 回覆；太長就分成多則訊息"""
+    repos = await known_repos()
+    if not repos:
+        return ["📁 沒有找到 Git repository"]
+
+    start = time.monotonic()
+    summaries = await dash_summaries(user_id, repos)
+    elapsed = time.monotonic() - start
+
+    dirty = sum(1 for s in summaries if s.changes)
+    unsynced = sum(1 for s in summaries if s.ahead or s.behind)
+    header = (
+        f"📊 **{config.machine_name}** — {len(repos)} 個 repo，"
+        f"{dirty} 個有變更，{unsynced} 個需要同步 ({elapsed:.1f}s)\n"
+    )
+
+    # 太長就分成多則訊息
+    chunks, current = [], []
+    size = 0
+    for line in format_dash(repos, summaries):
+        if current and size + len(line) > config.max_output_length:
+            chunks.append(current)
+            current, size = [], 0
+        current.append(line)
+        size += len(line) + 1
+    chunks.append(current)
+
+    texts = ["```\n" + "\n".join(chunk) + "\n```" for chunk in chunks]
+    return [header + texts[0], *texts[1:]]
+
+
 async def list_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """處理 /list"""
     if not is_user_allowed(update.effective_user.id):
         return
 
-    await update.message.reply_text("🔍 掃描中...")
+    query = " ".join(context.args or [])
+    all_repos = indexed_repos()
+    if all_repos is None and not query:
+        # 還沒有索引：邊掃邊拿到第一頁就回覆，完整索引在背景建立
+        msg = await update.message.reply_text("🔍 掃描中...")
+        context.application.create_task(refresh_repo_index())
+        repos = await asyncio.to_thread(first_git_repos, LIST_PAGE_SIZE)
+        if repos:
+            repos_text = "\n".join(f"  • `{r}`" for r in repos)
+            await msg.edit_text(
+                f"📁 **找到的 Git Repo（索引建立中）:**\n\n{repos_text}\n\n"
+                f"稍後再 /list 查看完整清單",
+                parse_mode="Markdown",
+            )
+            return
+    elif all_repos is not None and not repo_watcher.active:
+        # 先用索引回覆，背景再更新索引給下一次用
+        context.application.create_task(refresh_repo_index())
 
-    all_repos = []
-    for base in config.allowed_paths:
-        if base.exists():
-            repos = find_git_repos(base)
-            all_repos.extend(repos)
+    if query:
+        all_repos = (await known_repo_names()).search(query)
+    elif all_repos is None:
+        all_repos = await refresh_repo_index()
 
     if not all_repos:
+        if query:
+            await update.message.reply_text(
+                f"📁 沒有路徑包含 `{query}` 的 Git repository",
+                parse_mode="Markdown",
+            )
+            return
         await update.message.reply_text(
             "📁 沒有找到 Git repository\n\n"
             "允許的路徑:\n" + "\n".join(f"  • `{p}`" for p in config.allowed_paths),
@@ -299,14 +3121,30 @@ async def list_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         )
         return
 
-    repos_text = "\n".join(f"  • `{r}`" for r in all_repos[:30])
-    if len(all_repos) > 30:
-        repos_text += f"\n  ... 還有 {len(all_repos) - 30} 個"
+    key = listings.put(query, all_repos)
+    text, keyboard = render_list_page(key, listings.get(key), 0)
+    await update.message.reply_text(text, parse_mode="Markdown", reply_markup=keyboard)
 
-    await update.message.reply_text(
-        f"📁 **找到 {len(all_repos)} 個 Git Repo:**\n\n{repos_text}",
-        parse_mode="Markdown",
-    )
+
+async def list_page_callback(
+    update: Update, context: ContextTypes.DEFAULT_TYPE
+) -> None:
+    """/list 的翻頁按鈕：從快取的結果編輯同一則訊息"""
+    query = update.callback_query
+    if not is_user_allowed(query.from_user.id):
+        await query.answer("❌ 沒有權限")
+        return
+
+    _, key, page = query.data.split(":")
+    listing = listings.get(key)
+    if listing is None:
+        await query.answer("⌛ 清單已過期，請重新 /list")
+        await query.edit_message_reply_markup(None)
+        return
+
+    await query.answer()
+    text, keyboard = render_list_page(key, listing, int(page))
+    await query.edit_message_text(text, parse_mode="Markdown", reply_markup=keyboard)
 
 
 async def git_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -329,8 +3167,9 @@ async def git_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
             f"**範例:**\n"
             f"```\n"
             f"/git {config.machine_name} ~/projects/app pull\n"
-            f"/git {config.machine_name} ~/projects/app status\n"
+            f"/git {config.machine_name} app status\n"
             f"```\n\n"
+            f"路徑可以只打 repo 名稱或路徑結尾（例如 `clients/app`）\n"
             f"輸入 /list 查看專案",
             parse_mode="Markdown",
         )
@@ -340,12 +3179,23 @@ async def git_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     path_str = args[1]
     git_cmd = " ".join(args[2:])
 
-    # 不是這台機器，忽略
-    if machine.lower() != config.machine_name.lower():
+    # all 或機器群組：gateway 一次送給所有機器；各自連線的 bot 只看自己在不在裡面
+    targets = fanout_targets(machine)
+    if targets is not None:
+        if config.mode == "gateway":
+            await fanout_command(update, machine, targets, path_str, git_cmd)
+            return
+        if config.machine_name.lower() not in (t.lower() for t in targets):
+            return
+        machine = config.machine_name
+
+    # 不是這台機器：gateway 轉給 agent，否則忽略
+    local = machine.lower() == config.machine_name.lower()
+    if not local and config.mode != "gateway":
         return
 
     processing_msg = await update.message.reply_text(
-        f"🔄 `{config.machine_name}` 處理中...",
+        f"🔄 `{machine}` 處理中...",
         parse_mode="Markdown",
     )
 
@@ -353,101 +3203,126 @@ async def git_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     path_str = sanitize_input(path_str)
     git_cmd = sanitize_input(git_cmd)
 
-    # 驗證指令
-    is_valid, first_word = is_valid_git_command(git_cmd)
-    if not is_valid:
-        await processing_msg.edit_text(
-            f"❌ 不允許的指令: `{first_word or '(空)'}`\n\n"
-            f"允許: `{', '.join(config.allowed_git_commands)}`",
-            parse_mode="Markdown",
+    streamer = MessageStreamer(
+        processing_msg,
+        f"🔄 **{machine}** / `{Path(path_str).name}`\n📍 `git {git_cmd}`",
+        config.stream_edit_interval,
+    )
+    try:
+        machine, project_name, result = await run_on(
+            machine, user_id, path_str, git_cmd, on_output=streamer.update
         )
+    finally:
+        await streamer.close()
+
+    if result.rejected:
+        await processing_msg.edit_text(result.error, parse_mode="Markdown")
         return
 
-    # 解析路徑
     try:
-        target_path = Path(path_str).expanduser().resolve()
-    except Exception:
         await processing_msg.edit_text(
-            f"❌ 無效路徑: `{path_str}`", parse_mode="Markdown"
+            format_git_result(result, project_name, git_cmd, machine),
+            parse_mode="Markdown",
         )
+        if result.document:
+            filename = f"{project_name}-{git_cmd.split()[0]}.txt"
+            await send_output_document(
+                update.message, result.document, filename, result.cut_early
+            )
+    finally:
+        if result.document:
+            result.document.release()
+
+
+async def unknown_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """未知指令"""
+    if not is_user_allowed(update.effective_user.id):
         return
+    await update.message.reply_text("❓ 未知指令，輸入 /help 查看說明")
 
-    # 檢查存在
-    if not target_path.exists():
-        suggestions = []
-        for base in config.allowed_paths:
-            if base.exists():
-                repos = find_git_repos(base, max_depth=2)
-                suggestions.extend(repos[:5])
 
-        suggestion_text = ""
-        if suggestions:
-            suggestion_text = "\n\n**可能你要找:**\n" + "\n".join(
-                f"  • `{s}`" for s in suggestions[:5]
-            )
+# ============================================================
+# Update 並行處理
+# ============================================================
 
-        await processing_msg.edit_text(
-            f"❌ 資料夾不存在: `{target_path}`{suggestion_text}",
-            parse_mode="Markdown",
-        )
-        return
 
-    # 檢查是目錄
-    if not target_path.is_dir():
-        await processing_msg.edit_text(
-            f"❌ 不是資料夾: `{target_path}`", parse_mode="Markdown"
-        )
-        return
+# 目前這個 update 的「放行」callback：handler 把工作排進佇列後就呼叫，
+# 讓同一個 chat 的下一個 update 不必等 git 指令跑完
+chat_order_release: ContextVar[Callable[[], None] | None] = ContextVar(
+    "chat_order_release", default=None
+)
 
-    # 檢查允許範圍
-    if not is_path_allowed(target_path):
-        paths_list = "\n".join(f"  • `{p}`" for p in config.allowed_paths)
-        await processing_msg.edit_text(
-            f"❌ 路徑不在允許範圍: `{target_path}`\n\n**允許:**\n{paths_list}",
-            parse_mode="Markdown",
-        )
-        return
 
-    # 檢查 git repo
-    if not is_git_repo(target_path):
-        await processing_msg.edit_text(
-            f"❌ 不是 Git Repo: `{target_path}`\n\n💡 沒有 `.git` 目錄",
-            parse_mode="Markdown",
-        )
-        return
+def release_chat_order() -> None:
+    """工作已經排進佇列（順序已定），放開 chat 鎖與並行名額；重複呼叫無妨"""
+    if release := chat_order_release.get():
+        release()
 
-    # 執行
-    logger.info(f"User {user_id}: git {git_cmd} in {target_path}")
-    result = execute_git_command(target_path, git_cmd)
 
-    project_name = target_path.name
+class ChatOrderedProcessor(BaseUpdateProcessor):
+    """不同 chat 的 update 平行處理，同一個 chat 依到達順序開始
 
-    if result.error:
-        await processing_msg.edit_text(
-            f"❌ **{config.machine_name}** / `{project_name}`\n\n錯誤: {result.error}",
-            parse_mode="Markdown",
-        )
-    elif result.success:
-        await processing_msg.edit_text(
-            f"✅ **{config.machine_name}** / `{project_name}`\n"
-            f"📍 `git {git_cmd}`\n\n"
-            f"```\n{result.output}\n```",
-            parse_mode="Markdown",
-        )
-    else:
-        await processing_msg.edit_text(
-            f"⚠️ **{config.machine_name}** / `{project_name}`\n"
-            f"📍 `git {git_cmd}` (exit: {result.return_code})\n\n"
-            f"```\n{result.output}\n```",
-            parse_mode="Markdown",
-        )
+    同一個 chat 的 update 依序處理到 handler 呼叫 release_chat_order() 為止
+    （/git 是在 scheduler 登記 repo 內的順序或送出給 agent 時），之後下一個就
+    可以開始；同一個 repo 的先後由 RepoOrder 保證。所以一個跑很久的 pull 不會
+    卡住同一個 chat 的 /status 或其他 repo 的指令。
 
+    PTB 的 semaphore 在 do_process_update 之前就拿走，排隊等 chat 鎖的 update
+    也會佔名額；所以給它一個寬鬆的上限，真正的並行上限在拿到 chat 鎖之後才算。
+    """
 
-async def unknown_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """未知指令"""
-    if not is_user_allowed(update.effective_user.id):
-        return
-    await update.message.reply_text("❓ 未知指令，輸入 /help 查看說明")
+    def __init__(self, max_concurrent_updates: int) -> None:
+        super().__init__(max(1024, max_concurrent_updates))
+        self.running = asyncio.Semaphore(max_concurrent_updates)
+        self.chats: dict[int, tuple[asyncio.Lock, list[int]]] = {}
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            await self.run(coroutine, None)
+            return
+
+        # asyncio.Lock 依 FIFO 喚醒，所以同一個 chat 維持到達順序
+        lock, holders = self.chats.setdefault(chat.id, (asyncio.Lock(), [0]))
+        holders[0] += 1
+        try:
+            await lock.acquire()
+            await self.run(coroutine, lock)
+        finally:
+            holders[0] -= 1
+            if not holders[0]:
+                del self.chats[chat.id]
+
+    async def run(self, coroutine, lock: asyncio.Lock | None) -> None:
+        """拿並行名額執行 handler；鎖和名額在放行或 handler 結束時歸還"""
+        released = False
+
+        def release() -> None:
+            nonlocal released
+            if not released:
+                released = True
+                self.running.release()
+                if lock is not None:
+                    lock.release()
+
+        try:
+            await self.running.acquire()
+        except BaseException:
+            if lock is not None:
+                lock.release()
+            raise
+        token = chat_order_release.set(release)
+        try:
+            await coroutine
+        finally:
+            chat_order_release.reset(token)
+            release()
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
 
 
 # ============================================================
@@ -455,8 +3330,50 @@ async def unknown_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 # ============================================================
 
 
+def build_application(token: str, base_url: str | None = None) -> Application:
+    """建立 Application 並註冊 handler（base_url 給本機假 Bot API 測試用）"""
+
+    async def post_init(application: Application) -> None:
+        # 啟動時在背景更新 repo 索引，並視設定開始即時監看
+        application.create_task(refresh_repo_index())
+        if config.watch_repos:
+            application.create_task(repo_watcher.start())
+        if config.mode == "gateway":
+            await gateway.start()
+
+    builder = (
+        Application.builder()
+        .token(token)
+        .post_init(post_init)
+        .concurrent_updates(ChatOrderedProcessor(config.max_concurrent_updates))
+    )
+    if base_url:
+        builder = builder.base_url(base_url)
+    application = builder.build()
+
+    application.add_handler(CommandHandler("start", start_command))
+    application.add_handler(CommandHandler("help", help_command))
+    application.add_handler(CommandHandler("status", status_command))
+    application.add_handler(CommandHandler("list", list_command))
+    application.add_handler(
+        CallbackQueryHandler(list_page_callback, pattern=r"^list:[\w-]+:\d+$")
+    )
+    application.add_handler(CommandHandler("dash", dash_command))
+    application.add_handler(CommandHandler("git", git_command))
+    application.add_handler(MessageHandler(filters.COMMAND, unknown_command))
+    return application
+
+
 def main() -> None:
     """啟動 Bot"""
+    if config.mode in ("gateway", "agent") and not config.rpc_secret:
+        logger.error(f"❌ {config.mode} 模式需要在 config.json 設定 rpc_secret")
+        return
+    if config.mode == "agent":
+        logger.info(f"🚀 Starting Git Bot agent [{config.machine_name}]")
+        asyncio.run(run_agent())
+        return
+
     token = os.getenv("TELEGRAM_BOT_TOKEN")
 
     if not token:
@@ -468,16 +3385,20 @@ def main() -> None:
     logger.info(f"📁 Allowed paths: {config.allowed_paths}")
     logger.info(f"👤 Allowed users: {config.allowed_user_ids}")
 
-    application = Application.builder().token(token).build()
-
-    application.add_handler(CommandHandler("start", start_command))
-    application.add_handler(CommandHandler("help", help_command))
-    application.add_handler(CommandHandler("status", status_command))
-    application.add_handler(CommandHandler("list", list_command))
-    application.add_handler(CommandHandler("git", git_command))
-    application.add_handler(MessageHandler(filters.COMMAND, unknown_command))
-
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    application = build_application(token)
+    if config.webhook_url:
+        path = config.webhook_path or urlsplit(config.webhook_url).path
+        logger.info(f"🌐 Webhook: {config.webhook_listen}:{config.webhook_port}{path}")
+        application.run_webhook(
+            listen=config.webhook_listen,
+            port=config.webhook_port,
+            url_path=path.lstrip("/"),
+            webhook_url=config.webhook_url,
+            secret_token=config.webhook_secret or None,
+            allowed_updates=Update.ALL_TYPES,
+        )
+    else:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 
 if __name__ == "__main__":